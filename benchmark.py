@@ -0,0 +1,158 @@
+doc = ''' USAGE:   python benchmark.py  [-H HEIGHT] [-W WIDTH] [-z DEPTH] [--pitch 2144] [--gap 3] [--dtype uint16]
+                              [-m blur,harmonic,pyramid] [-en full,band,stencil] [-s 5] [-r 40] [-e 0] [-o results.json]
+
+   Measures mindagap on synthetic gridded panoramas with a known ground truth.
+   A smooth background with bright spots and slightly different exposure per tile is generated, then gridlines of
+   <gap> pixels every <pitch> pixels are zeroed, as in a stitched panorama. Every combination of the comma separated
+   methods, engines, box sizes, rounds and edges is filled in a fresh process and reported with:
+    - megapixels filled per second (best of --repeats runs) and CPU time
+    - peak resident memory of the process, and how much of it the fill added on top of the input (where the OS tells)
+    - blur rounds used (see --tolerance, none for harmonic and pyramid fills)
+    - reconstruction error of the gap pixels against the ground truth (mean absolute, RMS and maximum)
+
+   Results are printed and written as JSON, to compare engines and parameters before using them on real slides.
+
+   Example:  python benchmark.py -H 8000 -W 8000 -m blur,harmonic -en full,band -r 20,40 -o before.json
+   '''
+
+import os, sys, json, time, platform, itertools, contextlib, multiprocessing
+
+import numpy as np
+import cv2
+
+
+def synthetic_panorama(height, width, pitch = 2144, gap = 3, dtype = 'uint16', depth = 1, exposure = 0.1, seed = 0):
+    ''' Ground truth panorama (smooth background, bright spots, per tile exposure differences) and the same image
+    with zeroed gridlines of <gap> pixels every <pitch> pixels. 2D arrays for depth 1, z-stacks otherwise.'''
+
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype)
+    top, low = (np.iinfo(dtype).max, 1) if dtype.kind in 'ui' else (1.0, 1e-3)
+
+    # Exposure gain of each tile, expanded to pixels
+    gains = rng.normal(1, exposure, (height // pitch + 1, width // pitch + 1)).astype(np.float32)
+    gain = gains[(np.arange(height) // pitch)[:, None], (np.arange(width) // pitch)[None, :]]
+
+    truth = np.empty((depth, height, width), dtype = dtype)
+    for z in range(depth):
+        background = cv2.resize(rng.random((height // 64 + 2, width // 64 + 2), dtype = np.float32), (width, height), interpolation = cv2.INTER_CUBIC)
+
+        spots = np.zeros((height, width), dtype = np.float32)
+        for y, x, r, v in zip(rng.integers(0, height, height * width // 4000), rng.integers(0, width, height * width // 4000),
+                              rng.integers(2, 8, height * width // 4000), rng.random(height * width // 4000)):
+            cv2.circle(spots, (int(x), int(y)), int(r), float(v), -1)
+        spots = cv2.GaussianBlur(spots, (5, 5), 0)
+
+        layer = (0.05 + 0.3 * background + 0.5 * spots) * gain * top
+        truth[z] = np.clip(layer, low, top).astype(dtype)
+
+    img = truth.copy()
+    for x in range(pitch, width, pitch): img[:, :, x - gap // 2:x - gap // 2 + gap] = 0
+    for y in range(pitch, height, pitch): img[:, y - gap // 2:y - gap // 2 + gap, :] = 0
+
+    return((truth[0], img[0]) if depth == 1 else (truth, img))
+
+
+def run_case(case):
+    ''' Fills one synthetic panorama with the parameters of <case> (in its own process) and returns the measures'''
+
+    import mindagap
+
+    truth, img = synthetic_panorama(case['height'], case['width'], case['pitch'], case['gap'], case['dtype'], case['depth'], case['exposure'], case['seed'])
+    params = {k: case[k] for k in ['box_size', 'nloops', 'edges', 'engine', 'method', 'tol'] if k in case}
+    input_rss = mindagap.memory_mb()[1]
+
+    walls, cpus, info = [], [], {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for repeat in range(case['repeats']):
+            wall, cpu = time.perf_counter(), time.process_time()
+            if img.ndim == 2:
+                filled = mindagap.fill_grids(img, info = info, progress = False, **params)
+            else:
+                filled = mindagap.fill_array(img, case['workers'], info = info, **params)
+            walls.append(time.perf_counter() - wall) ; cpus.append(time.process_time() - cpu)
+
+    peak_rss = mindagap.memory_mb()[1]
+    gaps = img == 0
+    error = filled[gaps].astype(np.float64) - truth[gaps]
+
+    return(dict(case,
+                megapixels = img.size / 1e6, gap_pixels = int(gaps.sum()),
+                seconds = min(walls), cpu_seconds = min(cpus), megapixels_per_s = img.size / 1e6 / min(walls),
+                peak_rss_mb = peak_rss, fill_rss_mb = None if peak_rss is None else peak_rss - input_rss, 
+                rounds = info.get('rounds') if case.get('method', 'blur') == 'blur' else None,
+                mae = float(np.abs(error).mean()) if error.size else 0.0,
+                rmse = float(np.sqrt((error ** 2).mean())) if error.size else 0.0,
+                max_error = float(np.abs(error).max()) if error.size else 0.0))
+
+
+def benchmark_cases(methods = ['blur'], engines = ['full'], box_sizes = [5], rounds = [40], edges = [0], **setup):
+    ''' One case per combination of methods, engines, box sizes, rounds and edges (harmonic fills ignore the engine)'''
+
+    cases = []
+    for method, engine, box_size, nloops, edge in itertools.product(methods, engines, box_sizes, rounds, edges):
+        if method == 'harmonic' and engine != engines[0]: continue
+        cases.append(dict(setup, method = method, engine = engine, box_size = box_size, nloops = nloops, edges = edge))
+
+    return(cases)
+
+
+def run_benchmark(cases):
+    ''' Runs every case in a fresh process (so peak memory is per case) and returns the results'''
+
+    results = []
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild = 1) as pool:
+        for result in pool.imap(run_case, cases):
+            print(f"{result['method']:>9} {result['engine']:>8}  s={result['box_size']} r={result['nloops']} e={result['edges']}  "
+                  f"{result['megapixels_per_s']:8.2f} MP/s  {result['peak_rss_mb'] or float('nan'):8.0f} MB peak  rounds={result['rounds']}  "
+                  f"MAE={result['mae']:.2f} RMSE={result['rmse']:.2f}")
+            results.append(result)
+
+    return(results)
+
+
+#################################################################################
+
+
+if __name__ == '__main__':
+    import argparse
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import mindagap
+
+    listof = lambda kind: lambda text: [kind(v) for v in text.split(',')]
+
+    # Parse input arguments
+    parser = argparse.ArgumentParser(description="Benchmarks mindagap on synthetic gridded panoramas with known ground truth")
+    parser.add_argument("-H", '--height', type=int, default = 4288, help="Panorama height in pixels")
+    parser.add_argument("-W", '--width', type=int, default = 6432, help="Panorama width in pixels")
+    parser.add_argument("-z", '--depth', type=int, default = 1, help="Number of z-layers (filled with fill_array when > 1)")
+    parser.add_argument('--pitch', type=int, default = 2144, help="Tile size, distance between gridlines")
+    parser.add_argument('--gap', type=int, default = 3, help="Gridline width in pixels")
+    parser.add_argument('--dtype', default = 'uint16', choices = ['uint8', 'uint16', 'float32'], help="Pixel type")
+    parser.add_argument('--exposure', type=float, default = 0.1, help="Standard deviation of the exposure gain of each tile")
+    parser.add_argument('--seed', type=int, default = 0, help="Random seed of the synthetic panorama")
+    parser.add_argument("-m", '--methods', type=listof(str), default = ['blur'], help="Comma separated fill methods (blur, harmonic, pyramid)")
+    parser.add_argument("-en", '--engines', type=listof(str), default = ['full', 'band'], help="Comma separated blur engines (full, band, stencil)")
+    parser.add_argument("-s", '--sizekernel', type=listof(int), default = [5], help="Comma separated box sizes")
+    parser.add_argument("-r", '--rounds', type=listof(int), default = [40], help="Comma separated number of rounds")
+    parser.add_argument("-e", '--edges', type=listof(int), default = [0], help="Comma separated edge sizes (0 for none)")
+    parser.add_argument("-t", '--tolerance', type=float, default = None, help="Stop regions changing less than this per round")
+    parser.add_argument("-w", '--workers', type=int, default = 1, help="Layers filled in parallel (depth > 1)")
+    parser.add_argument("-n", '--repeats', type=int, default = 1, help="Runs per case, the fastest is reported")
+    parser.add_argument("-o", '--out', default = 'benchmark_results.json', help="Output JSON file")
+    args=parser.parse_args()
+
+    cases = benchmark_cases(args.methods, args.engines, args.sizekernel, args.rounds, args.edges,
+                            height = args.height, width = args.width, depth = args.depth, pitch = args.pitch, gap = args.gap,
+                            dtype = args.dtype, exposure = args.exposure, seed = args.seed, tol = args.tolerance,
+                            workers = args.workers, repeats = args.repeats)
+
+    print(f'Benchmarking {len(cases)} cases on a {args.depth} x {args.height} x {args.width} {args.dtype} panorama')
+    results = run_benchmark(cases)
+
+    with open(args.out, 'w') as f:
+        json.dump(dict(mindagap = mindagap.version_number, python = platform.python_version(), numpy = np.__version__,
+                       opencv = cv2.__version__, machine = platform.machine(), cpus = os.cpu_count(), results = results), f, indent = 1)
+
+    print(f'Saving: {args.out}')
@@ -1,4 +1,4 @@
-doc = ''' USAGE:   python duplicate_finder.py  <geneXYZ.txt> <Xtilesize> [Ytilesize==Xtilesize] [windowsize] [maxfreq] [minMode]  [-p True/False] 
+doc = ''' USAGE:   python duplicate_finder.py  <geneXYZ.txt> <Xtilesize> [Ytilesize==Xtilesize] [windowsize] [maxfreq] [minMode]  [-p True/False] [-w WORKERS] 
     (EXPERIMENTAL)
 
    Takes a single XYZ_coordinates.txt file and searches for duplicates along grid happening at every +/- 2144 pixels.
@@ -13,6 +13,19 @@ positional arguments:
 
 optional arguments:
   -p PLOT, --plot PLOT  Illustrative lineplot of duplicated pairs with annotated XYZ shift per tileOvlap
+  -w WORKERS, --workers WORKERS  Number of gridline bands processed in parallel (same output with any number)
+  -o OUTPUT, --output OUTPUT  'text' (default) writes <input>_markedDups.txt with duplicates renamed 'Duplicated', 
+                        'flags' only a compact boolean per row (<input>_duplicated.npy), 'both' writes both
+  --no-cache            Do not keep/read a binary copy of the input and the potential pair index of every gridline band
+                        (<input>.cache). Pairs only depend on windowsize and tile sizes, so reruns with other maxfreq, 
+                        minMode, --merge-dist or --max-multdist skip parsing and the partner search
+  --merge-dist          XYZ shifts closer than this (summed XYZ difference) to the mode count towards it. Default = 3
+  --max-multdist        Maximum shift corrected distance of duplicates (XY weighted 6 times Z). Default = 20
+  --fft {genes,pooled}  Also estimate the XY shift of every band by FFT cross-correlation of density grids of each side
+                        (genes kept apart by random phases, or all genes in one grid) and print it with its confidence
+                        next to the mode shift, as a check. Duplicates are still found from the mode as without it
+  -s [ROWS], --stream [ROWS]  Out-of-core: stream the input in chunks of rows into spill files per gridline band and
+                        process one band at a time (memory bounded by the largest band, not the whole table)
 
    Several pixel distance thresholds are tweekable through user input, but are default as:
     - The windowsize of search around the gridbreak is 30 pixels to each side.
@@ -32,336 +45,645 @@ optional arguments:
     Ricardo Guerreiro
     Resolve Biosciences'''
 
+import os, json, shutil
+from functools import partial
+import numpy as np, pandas as pd
 
-def mode3D(xs,ys,zs, minMode):
-    ''' Returns the most common combination of 3D coordinates
-    Takes into consideration if 2nd mode and 3rd mode are very close to 1st mode'''
 
-    # Transform coords into string for counting
-    coords3D = np.array([pair_xdists, pair_ydists, pair_zdists]).T.tolist()
-    str_transform =  [str(x)[1:-1] for x in coords3D]
-    
-    # Get most common coordinate string and return it as numbers
-    count = pd.Series(str_transform, dtype=str).value_counts()
+def compact_column(values, int_type):
+    ''' Coordinates as the given small integer type (int64 when they do not fit in it), 
+    or float32 when they are not whole numbers'''
 
-    # If there is a matrix with counts
-    if len(count):
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer) or np.array_equal(values, np.round(values)):
+        limits = np.iinfo(int_type)
+        fits = len(values) == 0 or (values.min() >= limits.min and values.max() <= limits.max)
+        return(values.astype(int_type if fits else np.int64))
 
-        check_rows = min([3, len(count)])
-        best = [np.array(x.split(','), dtype=int) for x in count.index[:check_rows]]
+    return(values.astype(np.float32))
 
-        # Sum counts of second and third mode if they are very close to first mode
-        for i in range(1,check_rows):
-            if abs(best[0] - best[i] ).sum()<3:
-                count [0] += count[i] 
 
-        ## If the most common count is bigger than minMode, shift is accepted as valid
-        if count [0] > minMode: 
+def read_transcripts(path_file, cache = True):
+    ''' Reads a gene xyz coordinates file (tab separated x, y, z, gene, extra columns ignored) into a compact 
+    table: x/y as int32, z as int16 (wider when values do not fit) and genes as categorical codes. 
+    With cache, the columns are also saved as .npy files in <path_file>.cache next to the input, 
+    and later runs memory map them instead of parsing the text again (until the input changes)'''
 
-            #print(f'At least {count [0]} duplications between tiles Y{xmin}:{xmax}, X{ymin}:{ymax}')
+    folder = path_file + '.cache'
+    stamp = input_stamp(path_file)
 
-            best = count.index[0].split(',')
-            return(np.array([int(c) for c in best]))
+    # Reuse the binary cache if it was made from this very input
+    try:
+        with open(os.path.join(folder, 'meta.json')) as f: 
+            if json.load(f) == stamp and cache:
+                col = {c: np.load(os.path.join(folder, c + '.npy'), mmap_mode = 'r') for c in ['x', 'y', 'z', 'codes']}
+                col['genes'] = np.load(os.path.join(folder, 'genes.npy'))
+                print('read input xyz cache')
+                return(pd.DataFrame(dict(x = col['x'], y = col['y'], z = col['z'], 
+                                         gene = pd.Categorical.from_codes(col['codes'], col['genes']))))
+    except (OSError, ValueError):
+        pass
 
-    # Reaches this point if almost none or no potential duplicates are found
-    #print(f'Probably no duplication between tiles Y{xmin}:{xmax}, X{ymin}:{ymax}')
-    return([0,0,0])
+    df = pd.read_csv(path_file, sep = '\t', header = None, usecols = range(4), names = ['x','y','z','gene'], dtype = {'gene': 'category'})
+    df = pd.DataFrame(dict(x = compact_column(df.x, np.int32), y = compact_column(df.y, np.int32),
+                           z = compact_column(df.z, np.int16), gene = df.gene))
+    print('read input xyz dataframe')
 
-def find_pot_partners_horizontal (xyzDF, bool_IDs,max_freq):
-    ''' Look for partners (same gene) in other side of the grid'''
-    partners,dists = {}, {}
-    pair_xdists, pair_ydists, pair_zdists = [] ,[], []    
-    pNUM = len(xyzDF) 
+    if cache:
+        try:
+            os.makedirs(folder, exist_ok = True)
+            for c in ['x', 'y', 'z']: np.save(os.path.join(folder, c + '.npy'), df[c].values)
+            np.save(os.path.join(folder, 'codes.npy'), df.gene.cat.codes.values)
+            np.save(os.path.join(folder, 'genes.npy'), np.asarray(df.gene.cat.categories, dtype = str))
+            with open(os.path.join(folder, 'meta.json'), 'w') as f: json.dump(stamp, f)
+        except OSError as e:
+            print(f'Could not write cache {folder}: {e}')
 
-    # Deal with empty input and filter out too common genes
-    if len(bool_IDs) > 0: 
-        gen_counts = xyzDF.gene.value_counts()
+    return(df)
 
-        common_gens = []
 
-        for g, c in gen_counts.items():
-            if c > max_freq:
-                common_gens.append(g) 
-            else: break
-    else:  return([0,0,0])
-                           
+def write_duplicates(df, duplicated, pathname, output = 'text'):
+    ''' Writes the duplicate marks: 'text' rewrites the input with gene name 'Duplicated' for duplicates 
+    (<pathname>_markedDups.txt), 'flags' saves one boolean per input row (<pathname>_duplicated.npy), 'both' does both'''
 
-    #print('horizontal') ; #print(xyzDF[bool_IDs].gene.value_counts())
+    flags = np.zeros(len(df), dtype = bool)
+    flags[duplicated] = True
 
-    for i,(og_i,x1,y1,z1,gen1,partners) in xyzDF[bool_IDs].iterrows():
+    if output in ('flags', 'both'):
+        np.save(pathname + '_duplicated.npy', flags)
 
-        # Check neighbours before and after (it's sorted by y values)
-        for n in [*range(-30,0)]+[*range(1,30)]:  #-1,-2       
-            if i +n > 0 and i+n < pNUM and xyzDF.x[i+n]>x1-7:
-                if xyzDF.x[i+n]>x1+7: break # Quit searching if neighbors are far in y axis
+    # Replace Gene name by Duplicated and write new XYZ.txt file 
+    if output in ('text', 'both'):
+        genes = df.gene.astype(str) if not isinstance(df.gene.dtype, pd.CategoricalDtype) else \
+                df.gene.cat.add_categories([c for c in ['Duplicated'] if c not in df.gene.cat.categories])
+        genes[flags] = 'Duplicated'
+        df.assign(gene = genes).to_csv(pathname + '_markedDups.txt', sep = '\t', header=None, index = False )
 
-                partner = xyzDF.loc[i+n]
+    return(flags)
 
-                # Partner is good if same gene, on the other side of grid, is within 10 pixels in Y direction and 5 in Z.
-                if partner.gene == gen1 not in common_gens: # and partner.y >= yjump: 
-                    if abs(partner.z - z1) <7 and abs(partner.x - x1) <7: 
-                        if partner.y - y1  >2 and partner.y - y1 < w-5: # Do not consider very large parallel distances (far left transcript only connects with transcripts on the left of panel2)
 
-                            # Potential partner has been found  
-                            pair_xdists.append(partner.x - x1) 
-                            pair_ydists.append(partner.y - y1) 
-                            pair_zdists.append(partner.z - z1) 
+def fft_shift(xyzDF, jump, along, w, max_freq, per_gene = True, projections = 8, seed = 0):
+    ''' Estimates the shift across a gridline by FFT cross-correlation, without listing candidate pairs:
+    each side of the band is rasterised into 1 pixel density grids (along x across the line) of the genes with 
+    at most max_freq transcripts, and the grids are cross-correlated. The cost depends on band area, not on pair number.
+    With per_gene, only same gene coincidences should count: every gene gets a random phase in a complex grid, so 
+    same gene products add up while other genes cancel out on average (averaged over <projections> random phasings, 
+    a few FFTs instead of one per gene). Otherwise all genes are pooled in one grid.
+    The peak is searched among the shifts allowed for partners (see find_pot_partners) and refined to subpixel 
+    with a parabola through its neighbours. Confidence is the peak height in standard deviations above the mean 
+    of the searched correlations.
+    Returns the shift (second side minus first) along and across the line, and its confidence'''
 
-                            partners.append(partner['index']) 
-                            xyzDF.loc[old_ids[partner['index']],'partners'].append(og_i) 
+    across = 'x' if along == 'y' else 'y'
+    a, c = xyzDF[along].values, xyzDF[across].values
+    genes, codes = gene_codes(xyzDF)
 
-    return(pair_xdists,pair_ydists,pair_zdists)
+    # Grid positions (origin at the band corner) of the transcripts of rare genes
+    rare = np.bincount(codes, minlength = len(genes))[codes] <= max_freq
+    if not rare.any(): return(np.zeros(2), 0.0)
+
+    a, c, codes, first = a[rare] - a[rare].min(), c[rare] - (jump - w), codes[rare], c[rare] < jump
 
-def find_pot_partners_vertical (xyzDF, bool_IDs,max_freq):
-    ''' Look for partners (same gene) in other side of the grid'''
-    partners,dists = {}, {}
-    pair_xdists, pair_ydists, pair_zdists = [] ,[], []  
-    pNUM = len(xyzDF) 
-    
+    # Zero padding beyond the largest searched shift, so shifts do not wrap around
+    shape = (a.max() + 1 + 8, 2 * w + w)
+    flat = a * shape[1] + c
+
+    # One random phase per gene and projection (a single unit weight when pooled)
+    if per_gene:
+        phases = np.exp(2j * np.pi * np.random.default_rng(seed).random((projections, len(genes))))[:, codes]
+    else:
+        phases = np.ones((1, len(codes)))
+
+    grids = []
+    for side in (first, ~first):
+        grid = np.zeros((len(phases), shape[0] * shape[1]), dtype = complex)
+        for grid_p, phase in zip(grid, phases[:, side]):
+            grid_p += np.bincount(flat[side], phase.real, minlength = grid.shape[1]) + 1j * np.bincount(flat[side], phase.imag, minlength = grid.shape[1])
+        grids.append(np.fft.fft2(grid.reshape(-1, *shape)))
+
+    # corr[da, dc] = sum over grid pixels p of first[p] * second[p + (da, dc)]
+    corr = np.fft.ifft2((grids[0].conj() * grids[1]).mean(axis = 0)).real
+
+    # Allowed shifts: less than 7 pixels along (negative ones wrapped to the end), 2 to w-5 pixels across
+    along_shifts = np.r_[0:7, -6:0]
+    across_shifts = np.arange(3, w - 5)
+    allowed = corr[along_shifts][:, across_shifts]
+    if allowed.size == 0 or allowed.std() == 0: return(np.zeros(2), 0.0)
+
+    pa, pc = np.unravel_index(allowed.argmax(), allowed.shape)
+    confidence = (allowed[pa, pc] - allowed.mean()) / allowed.std()
+
+    # Subpixel refinement: vertex of the parabola through the peak and its two neighbours on each axis
+    def vertex(left, peak, right):
+        curve = left - 2 * peak + right
+        return(0.5 * (left - right) / curve if curve < 0 else 0.0)
+
+    da, dc = along_shifts[pa], across_shifts[pc]
+    shift = np.array([da + vertex(corr[da - 1, dc], corr[da, dc], corr[(da + 1) % shape[0], dc]),
+                      dc + vertex(corr[da, dc - 1], corr[da, dc], corr[da, dc + 1])])
+
+    return(shift, float(confidence))
+
+
+def mode3D(xs,ys,zs, minMode, merge_dist = 3):
+    ''' Returns the most common combination of 3D coordinates (integer distances)
+    Takes into consideration the counts of combinations very close to the mode (L1 distance < merge_dist): 
+    the mode is only valid if it and its neighbourhood occur more than minMode times'''
+
+    coords3D = np.column_stack([xs, ys, zs]).astype(np.int64)
+
+    # Reaches this point if no potential duplicates are found
+    if len(coords3D) == 0: return(np.array([0,0,0]))
+
+    # Pack each XYZ combination into one integer and count them (ties go to the first seen)
+    low = coords3D.min(axis = 0)
+    sizes = coords3D.max(axis = 0) - low + 1
+    packed = ((coords3D[:, 0] - low[0]) * sizes[1] + coords3D[:, 1] - low[1]) * sizes[2] + coords3D[:, 2] - low[2]
+    uniq, first, count = np.unique(packed, return_index = True, return_counts = True)
+    best = np.lexsort((first, -count))[0]
+    combos = coords3D[first]
+
+    # Sum counts of combinations very close to the mode
+    near = np.abs(combos - combos[best]).sum(axis = 1) < merge_dist
+
+    ## If the mode and its neighbourhood are more common than minMode, shift is accepted as valid
+    if count[near].sum() > minMode: 
+        return(combos[best])
 
-    # Deal with empty input and filter out too common genes
-    if len(bool_IDs) > 0: 
-        gen_counts = xyzDF.gene.value_counts()
+    # Reaches this point if almost no potential duplicates are found
+    return(np.array([0,0,0]))
+
+
+def gene_codes(xyzDF):
+    ''' Gene names and the integer code of every transcript's gene'''
 
-        common_gens = []
+    if isinstance(xyzDF.gene.dtype, pd.CategoricalDtype):
+        return(xyzDF.gene.cat.categories, xyzDF.gene.cat.codes.values.astype(np.int64))
 
-        for g, c in gen_counts.items():
-            if c > max_freq:
-                common_gens.append(g) 
-            else: break
-    else: return([0,0,0])
-                        
+    return(np.unique(xyzDF.gene.values.astype(str), return_inverse = True))
+
+
+def find_pot_partners(xyzDF, query, max_freq, w, along = 'y', other = None):
+    ''' Look for partners (same gene) in other side of the grid, for all <query> transcripts at once.
+    xyzDF is one gridline band, <along> the axis parallel to the gridline ('y' for vertical lines). 
+    Partners are within 7 pixels along the line and in Z, 2 to w-5 pixels further across the line, 
+    and among <other> transcripts when given (e.g. only right of a vertical line). Genes with more than
+    max_freq transcripts in the band are left out. 
+    Transcripts are sorted by gene and position along the line, so partners of each transcript are 
+    one range of that order (found with searchsorted), no matter how many transcripts lie in between.
+    Returns the band positions of each pair (i query, j partner, ordered by i then j) and their XYZ distances (j - i)'''
 
-    for i,(og_i,x1,y1,z1,gen1,partners) in xyzDF[bool_IDs].iterrows():
-
-        # Check neighbours before and after (it's sorted by y values)
-        for n in [*range(-30,0)]+[*range(1,30)]:  #-1,-2       
-            if i +n > 0 and i+n < pNUM and xyzDF.y[i+n]>y1-7:
-
-                if xyzDF.y[i+n]>y1+7: break # Quit searching if neighbors are far in y axis
-
-                partner = xyzDF.loc[i+n]
-
-                # Partner is good if same gene, on the other side of grid, is within 10 pixels in Y direction and 5 in Z.
-                if partner.gene == gen1 not in common_gens and partner.x >= xjump: 
-                    if abs(partner.z - z1) <7 and abs(partner.y - y1) <7: 
-
-                        if partner.x - x1  >2 and partner.x - x1 < w -5 : # Do not consider very large parallel distances (far left transcript only connects with transcripts on the left of panel2)
-
-                            # Potential partner has been found  
-                            pair_xdists.append(partner.x - x1) 
-                            pair_ydists.append(partner.y - y1) 
-                            pair_zdists.append(partner.z - z1) 
-
-                            partners.append(partner['index']) 
-                            xyzDF.loc[old_ids[partner['index']],'partners'].append(og_i) 
-
-    return(pair_xdists,pair_ydists,pair_zdists)
-
-class pointi:
-    ''' Point class with computed distances to partners ''' 
-    def __init__(self,idx,shift):
-        self.id = idx
-        self.point = df1.loc[idx]
-        self.partners = self.point.partners
-        self.best_partner = None
-        
-        if len(self.partners)== 0: return(None)
-    
-        # Signal to deal with p1 and p2 being either first-second or second-first 
-        sig = (self.point.values[:3] - df1.loc[self.partners[0]].values[:3]).sum() +0.0001
-        sig /= abs(sig)
-        
-        # Calculate distance between point1 and partners
-        self.dists = [abs(sig * self.point.values[:3] - sig*df1.loc[p].values[:3] - shift).astype(int) for p in self.partners]   
-        self.dists3D = [d.sum() for d in self.dists]  
-        self.best_dist =  min(self.dists3D)
-        
-        # Identify which partner has best (minimum) distance         
-            # Giving more weight to x,y coordinates than z 
-        mult_dists = (self.dists * np.array([6,6,1])).sum(axis=1)
-        self.best_multdist =    mult_dists.min()
-        minNUM = (mult_dists == mult_dists.min()).sum()  # (self.dists3D == self.best_dist).sum() 
-
-        if minNUM == 1:
-            self.best_partner = self.partners[mult_dists.argmin()] 
-        else:     # Deal with multiple best partners (equal dist)
-            
-            # Prefer distance arrays with smaller SD ([3,1] is better than [4,0]). 
-            min_sd = np.std(self.dists,axis=1).argmin()    # If SD is exactly equal, first is taken
-            self.best_partner = self.partners[min_sd]
-    
+    across = 'x' if along == 'y' else 'y'
+    xyz = xyzDF[['x', 'y', 'z']].values
+    a, c = xyzDF[along].values, xyzDF[across].values
+    genes, codes = gene_codes(xyzDF)
 
-###########################   MAIN  ##############################################
+    # Filter out too common genes
+    rare = np.bincount(codes, minlength = len(genes))[codes] <= max_freq
+    query = np.asarray(query) & rare
+    other = rare if other is None else np.asarray(other) & rare
+
+    # Sort candidate partners by gene, then along the line: one key per transcript, genes far apart
+    span = a.max() - a.min() + 16
+    key = codes * span + (a - a.min())
+    pool = np.flatnonzero(other)
+    pool = pool[np.argsort(key[pool], kind = 'stable')]
+    sorted_key = key[pool]
 
-                        
-if __name__ == '__main__':
-    import os,glob, argparse
-    import numpy as np, pandas as pd
-    import matplotlib.pyplot as plt
+    # Partners of each query transcript are one range of the sorted pool (less than 7 pixels along the line)
+    i = np.flatnonzero(query)
+    lo = np.searchsorted(sorted_key, key[i] - 7, side = 'right')
+    hi = np.searchsorted(sorted_key, key[i] + 7, side = 'left')
+    counts = hi - lo
+    start = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    i = np.repeat(i, counts)
+    j = pool[start + np.arange(len(i))]
 
-    parser = argparse.ArgumentParser(description = 'Takes a single XYZ_coordinates.txt file and searches for duplicates along grid happening at every 2144 pixels')
-    parser.add_argument("input", help="Input gene xyz coordinates file")
-    parser.add_argument("Xtilesize", nargs = '?', type=int, default = 2144,  help="Tile size (distance between gridlines) on X axis")
-    parser.add_argument("Ytilesize", nargs = '?', type=int, default = None,  help="Tile size (distance between gridlines) on Y axis")
-    parser.add_argument("windowsize", nargs = '?', type=int, default = 30,  help="Window arround gridlines to search for duplicates")
-    parser.add_argument("maxfreq", nargs = '?', type=int, default = 400,  help="Maximum transcript count to calculate X/Y shifts (better to discard very common genes)")
-    parser.add_argument("minMode", nargs = '?', type=int, default = 10,  help="Minumum occurances of ~XYZ_shift to consider it valid")
-    parser.add_argument("-p", "--plot", default = None,  help="Illustrative lineplot of duplicated pairs with annotated XYZ shift per tileOvlap")
-    args=parser.parse_args()
+    # Partner is good if within 7 pixels in Z and on the other side of grid (very large parallel distances not considered)
+    dists = xyz[j] - xyz[i]
+    d_across = c[j] - c[i]
+    good = (np.abs(dists[:, 2]) < 7) & (d_across > 2) & (d_across < w - 5)
+    i, j, dists = i[good], j[good], dists[good]
 
-    # Sanity checks of input
-    pathname, extension = os.path.splitext(args.input)
+    order = np.lexsort((j, i))
+    return(i[order], j[order], dists[order])
 
-    if os.path.exists(args.input) == False:
-        print("Input file does not exist!"); exit()
 
-    # Read input
-    df = pd.read_csv(args.input, sep = '\t', header = None)  # '../../../13_rois_for_demo/panoramas/RiceRoot_Transcripts.txt', sep = '\t', header = None)
-    df = df.drop(df.columns[4:], axis = 1)
-    df.columns = ['x','y','z','gene'] #,'qual']
-    print('read input xyz dataframe')
+def band_members(across, along, across_size, along_size, w, across_max = np.inf):
+    ''' Transcripts in the bands around gridlines: less than w pixels from a gridline (multiples of across_size 
+    below across_max) and strictly inside one tile along it. <across> is the coordinate perpendicular to the 
+    gridlines, <along> the parallel one (x and y for vertical gridlines).
+    Returns the rows, tile number along the line and gridline number of each membership'''
 
-    # Prepare parameters 
-    w = args.windowsize
-    minMode = args.minMode
-    max_freq = args.maxfreq
-    Xtilesize = args.Xtilesize #2144
-    Ytilesize = args.Xtilesize if args.Ytilesize == None else args.Ytilesize 
-    panoYmax, panoXmax = df.y.max(), df.x.max()
-    duplicated = [] 
-    tileOvlaps, totalDups, tilePairs = 0, 0, 0
+    across, along = np.asarray(across), np.asarray(along)
+    tile = along // along_size
+    inside = along % along_size != 0
 
-    # First iteration going through vertical lines 
-    for yjump in range(0, panoYmax, Ytilesize):
-        ymin,ymax = yjump,yjump + Ytilesize
+    # Nearest gridline below and above each transcript (both bands when w is over half a tile)
+    rows, tiles, lines = [], [], []
+    for offset in (0, 1):
+        line = across // across_size + offset
+        member = inside & (np.abs(across - line * across_size) < w) & (line > 0) & (line * across_size < across_max)
+        rows.append(np.flatnonzero(member))
+        tiles.append(tile[member]) ; lines.append(line[member])
 
-        for xjump in range(Xtilesize, panoXmax, Xtilesize):
+    return(np.concatenate(rows), np.concatenate(tiles).astype(np.int64), np.concatenate(lines).astype(np.int64))
 
-            xmin,xmax = xjump - w, xjump + w
 
-            # Filtered points for only one grid line 
-            df1 = df[(df.x > xmin)*(df.x < xmax) *
-                     (df.y > ymin)*(df.y < ymax)].sort_values('y').reset_index()
+def gridline_bands(across, along, across_size, along_size, w, across_max):
+    ''' Assigns every transcript, in one pass, to the bands around the gridlines it falls in (see band_members).
+    Returns a dict {(tile number along the line, gridline number): transcript rows sorted along the line (ties in input order)}'''
 
-            # Skip rest if no transcripts exist 
-            if df1.empty:
-                print(f'Found no transcripts within Y{xmin}:{xmax}, X{ymin}:{ymax}')
-                continue     
+    along = np.asarray(along)
+    rows, tiles, lines = band_members(across, along, across_size, along_size, w, across_max)
 
-            if args.plot: # Plot gridlines if asked
-                rectangle = plt.Rectangle((xmin,ymin), 2*w , ymax -ymin, fill=False, ec="grey", linewidth = 0.3)
-                plt.gca().add_patch(rectangle)
+    # Group rows by band, sorted along the line within each band (ties in input order)
+    order = np.lexsort((rows, along[rows], lines, tiles))
+    rows, tiles, lines = rows[order], tiles[order], lines[order]
+    starts = np.flatnonzero(np.r_[True, (tiles[1:] != tiles[:-1]) | (lines[1:] != lines[:-1])])
 
-            tilePairs +=1 
-            left = df1.x < xjump
-            df1['partners'] = np.empty((len(df1), 0)).tolist()
-   
-            old_ids = {k:i for i,k in enumerate(df1['index'])}
+    return({(tiles[a], lines[a]): band for a, band in zip(starts, np.split(rows, starts[1:]))})
 
-            # Find potential partners and report the XYZ distances between them
-            pair_xdists,pair_ydists,pair_zdists = find_pot_partners_vertical(df1, left, max_freq)
 
-            # Use original index again and find mode of XYZ shift between potential duplicates
-            df1 = df1.set_index('index')
-            shift = mode3D(pair_xdists, pair_ydists, pair_zdists, minMode)
+# One transcript of a band spill file: input row number, coordinates and gene code
+spill_record = np.dtype([('index', '<i8'), ('x', '<f8'), ('y', '<f8'), ('z', '<f4'), ('gene', '<i4')])
 
-            if args.plot: # Annotate plot with XYZ shift between tiles
-                plt.text(xmin-400, ymin+1000, str(shift), size = 4)
 
-            # If these is a shift 
-            if max(shift) > 2:
-                dups = 0 
+def spill_bands(path_file, Xtilesize, Ytilesize, w, folder, chunk_rows = 2000000):
+    ''' Streams a gene xyz coordinates file in chunks of rows and appends the transcripts of every gridline band 
+    to its own spill file in <folder> (rows in input order), so the whole table is never in memory.
+    Returns the spill files {('vertical'|'horizontal', tile number, gridline number): path}, the number of rows, 
+    the largest x and y and the gene names (gene codes index them)'''
 
-                #### Confirm duplications through mutual best partner and distance #####
-                for i in df1.index[left]:
+    files, gene_codes = {}, {}
+    nrows, panoXmax, panoYmax = 0, None, None
 
-                    p1 = pointi(i,shift)
-                    bp1 = p1.best_partner
-                    
-                    if bp1:
-                        p2 = pointi(bp1,shift)
-                        bp2 = p2.best_partner
+    for chunk in pd.read_csv(path_file, sep = '\t', header = None, usecols = range(4), names = ['x','y','z','gene'], chunksize = chunk_rows):
+        genes, inverse = np.unique(chunk.gene.values.astype(str), return_inverse = True)
+        records = np.empty(len(chunk), dtype = spill_record)
+        records['index'] = np.arange(nrows, nrows + len(chunk))
+        records['x'], records['y'], records['z'] = chunk.x.values, chunk.y.values, chunk.z.values
+        records['gene'] = np.array([gene_codes.setdefault(g, len(gene_codes)) for g in genes], dtype = np.int32)[inverse]
+
+        for kind, across, along, across_size, along_size in [('vertical', records['x'], records['y'], Xtilesize, Ytilesize), 
+                                                             ('horizontal', records['y'], records['x'], Ytilesize, Xtilesize)]:
+            rows, tiles, lines = band_members(across, along, across_size, along_size, w)
+            order = np.lexsort((rows, lines, tiles))
+            rows, tiles, lines = rows[order], tiles[order], lines[order]
+            starts = np.flatnonzero(np.r_[True, (tiles[1:] != tiles[:-1]) | (lines[1:] != lines[:-1])]) if len(rows) else []
 
-                        if i == bp2 and p1.best_multdist < 20:
-                            duplicated.append(i) 
-                            dups +=1  
+            for a, band in zip(starts, np.split(rows, starts[1:])):
+                key = (kind, int(tiles[a]), int(lines[a]))
+                files.setdefault(key, os.path.join(folder, f'{kind}_{key[1]}_{key[2]}.bin'))
+                with open(files[key], 'ab') as f: records[band].tofile(f)
 
-                            if args.plot:
-                                plt.plot([p1.point.x, p2.point.x],
-                                    [p1.point.y, p2.point.y], c = 'red', linewidth = 0.2 )
+        nrows += len(chunk)
+        panoXmax = chunk.x.max() if panoXmax is None else max(panoXmax, chunk.x.max())
+        panoYmax = chunk.y.max() if panoYmax is None else max(panoYmax, chunk.y.max())
+        print(f'Spilled {nrows} transcripts into gridline bands')
 
-                # Count Tileoverlap with at least 5 duplicated points    
-                if dups > 4: 
-                    totalDups += dups
-                    tileOvlaps +=1 
-            
+    return(files, nrows, panoXmax, panoYmax, np.array(list(gene_codes), dtype = str))
 
-    # Second iteration going through horizontal lines    
-    for xjump in range(0, panoXmax, Xtilesize):
 
-        xmin,xmax = xjump,xjump + Xtilesize
+def read_band(path_file, along, genes):
+    ''' One gridline band from its spill file (see spill_bands) as a compact table sorted along the line'''
 
-        for yjump in range(Ytilesize, panoYmax, Ytilesize):
+    records = np.fromfile(path_file, dtype = spill_record)
+    records = records[np.argsort(records[along], kind = 'stable')]
 
-            ymin,ymax = yjump -w, yjump + w
+    return(pd.DataFrame({'index': records['index'], 'x': compact_column(records['x'], np.int32), 'y': compact_column(records['y'], np.int32),
+                         'z': compact_column(records['z'], np.int16), 'gene': pd.Categorical.from_codes(records['gene'], genes)}))
 
-            # Filtered points for only one grid line 
-            df1 = df[(df.x > xmin)*(df.x < xmax) *
-                     (df.y > ymin)*(df.y < ymax)].sort_values('x').reset_index()
 
-            if df1.empty:
-                print(f'Found no transcripts within Y{xmin}:{xmax}, X{ymin}:{ymax}')
-                continue  
+def spilled_band_pairs(path_file, jump, along, w, genes, **fft):
+    ''' band_pairs for a band read from its spill file (only that band is loaded, in the worker)'''
 
-            if args.plot: # Plot gridlines if asked
-                rectangle = plt.Rectangle((xmin,ymin), xmax -xmin, 2*w, fill=False, ec="grey", linewidth = 0.3)
-                plt.gca().add_patch(rectangle)
+    return(band_pairs(read_band(path_file, along, genes), jump, along, w, **fft))
 
-            tilePairs +=1 
-            bottom = df1.y < yjump
-            df1['partners'] = np.empty((len(df1), 0)).tolist()
-   
-            old_ids = {k:i for i,k in enumerate(df1['index'])}
 
-            # Find potential partners and report the XYZ distances between them
-            pair_xdists,pair_ydists,pair_zdists = find_pot_partners_horizontal(df1, bottom,max_freq)
+def write_duplicates_streamed(path_file, duplicated, pathname, output = 'text', nrows = None, chunk_rows = 2000000):
+    ''' write_duplicates without loading the input: the input is read again in chunks of rows and the marked
+    rows are written out in input order. Flags are written to a memory-mapped .npy file.'''
 
-            # Use original index again and find mode of XYZ shift between potential duplicates
-            df1 = df1.set_index('index')
-            shift = mode3D(pair_xdists, pair_ydists, pair_zdists, minMode)
+    if output in ('flags', 'both'):
+        flags = np.lib.format.open_memmap(pathname + '_duplicated.npy', mode = 'w+', dtype = bool, shape = (nrows,))
+        flags[np.asarray(duplicated, dtype = np.int64)] = True
+        flags.flush() ; del flags
 
-            if args.plot: # Annotate plot with XYZ shift between tiles
-                plt.text(xmin+1000, ymin-100, str(shift), size = 4)
-            
-            # If there is a shift 
-            if max(shift)> 2:
-                dups = 0 
+    if output in ('text', 'both'):
+        duplicated = np.sort(np.asarray(duplicated, dtype = np.int64))
+        start = 0
+
+        with open(pathname + '_markedDups.txt', 'w') as f:
+            for chunk in pd.read_csv(path_file, sep = '\t', header = None, usecols = range(4), names = ['x','y','z','gene'], chunksize = chunk_rows):
+                chunk = pd.DataFrame(dict(x = compact_column(chunk.x, np.int32), y = compact_column(chunk.y, np.int32),
+                                          z = compact_column(chunk.z, np.int16), gene = chunk.gene.astype(str)))
+                marked = duplicated[(duplicated >= start) & (duplicated < start + len(chunk))] - start
+                chunk.iloc[marked, 3] = 'Duplicated'
+                chunk.to_csv(f, sep = '\t', header=None, index = False )
+                start += len(chunk)
+
+
+def group_first(groups, *keys):
+    ''' Position of the first element of each group (groups sorted) when ordered by keys (last key sorts first), ties by position'''
+
+    order = np.lexsort((np.arange(len(groups)),) + keys + (groups,))
+    starts = np.flatnonzero(np.r_[True, groups[order][1:] != groups[order][:-1]])
+
+    return(order[starts])
+
+
+def best_partners(n, i, j, pair_dists, shift, weights = (6,6,1)):
+    ''' Best partner of each of the <n> transcripts of a band from the potential partner pairs (i, j) and their 
+    XYZ distances of find_pot_partners: 
+    the partner whose XYZ distance corrected by <shift> is smallest, XY weighted 6 times more than Z.
+    If several partners share the smallest distance, the partner (of all) whose corrected distances have the 
+    smallest SD is taken ([3,1] is better than [4,0]), the first one if equal. Partners are in order of discovery.
+    Returns the best partner position of each transcript (-1 without partners) and its weighted distance'''
+
+    # Both directions of every pair, grouped by transcript in order of discovery
+    src, dst = np.c_[i, j].ravel(), np.c_[j, i].ravel()
+    diff = np.stack([-pair_dists, pair_dists], axis = 1).reshape(-1, 3)   # XYZ of transcript minus partner
+    order = np.argsort(src, kind = 'stable')
+    src, dst, diff = src[order], dst[order], diff[order]
+    starts = np.flatnonzero(np.r_[True, src[1:] != src[:-1]]) if len(src) else np.array([], dtype = int)
+
+    # Signal to deal with p1 and p2 being either first-second or second-first (from the first partner)
+    sig = np.repeat(np.sign(diff[starts].sum(axis = 1) + 0.0001), np.diff(np.r_[starts, len(src)]))
+    dists = np.abs(sig[:, None] * diff - shift).astype(int)
+    mult_dists = (dists * np.array(weights)).sum(axis = 1)
+
+    # Minimum weighted distance per transcript, and how many partners share it
+    best_mult = np.minimum.reduceat(mult_dists, starts) if len(starts) else mult_dists
+    is_min = mult_dists == np.repeat(best_mult, np.diff(np.r_[starts, len(src)]))
+    ties = np.add.reduceat(is_min, starts) > 1 if len(starts) else is_min
+
+    by_dist = group_first(src, mult_dists)
+    by_sd = group_first(src, np.std(dists, axis = 1))
+    best = np.full(n, -1)
+    best_multdist = np.full(n, np.iinfo(np.int64).max)
+    best[src[starts]] = dst[np.where(ties, by_sd, by_dist)]
+    best_multdist[src[starts]] = best_mult
+
+    return(best, best_multdist)
+
+
+def band_pairs(df1, jump, along, w, fft = None, max_freq = 400):
+    ''' Potential duplicate pairs of one gridline band, the expensive step, which only depends on geometry and w: 
+    df1 holds the transcripts within w pixels of the gridline at <jump> (original index in an 'index' column, 
+    sorted <along> the line: 'y' for vertical lines, 'x' for horizontal ones). Self-contained, so bands can be 
+    processed in parallel. Pairs of all genes are kept, with their band gene count to filter common genes later.
+    Returns a dict of arrays: pairs (band positions i, j, XYZ distances, gene count) and per transcript 
+    its original index, x, y and whether it is on the first side of the line (see confirm_band).
+    With fft = 'genes' (or 'pooled'), the XY shift estimated by fft_shift (genes under max_freq) and its confidence 
+    are added as 'fft_shift' and 'confidence', to check the mode shift against. The pairs are the same.'''
+
+    across = 'x' if along == 'y' else 'y'
+    first = (df1[across] < jump).values
+
+    # Find potential partners (right of vertical lines) and report the XYZ distances between them
+    pi, pj, pair_dists = find_pot_partners(df1, first, np.inf, w, along, other = df1.x >= jump if along == 'y' else None)
+    genes, codes = gene_codes(df1)
+
+    pairs = dict(i = pi, j = pj, dists = pair_dists, gene_count = np.bincount(codes, minlength = len(genes))[codes[pi]],
+                 index = df1['index'].values, x = df1.x.values, y = df1.y.values, first = first)
+
+    # Independent shift estimate by cross-correlation (along, across turned into X, Y)
+    if fft:
+        shift, pairs['confidence'] = fft_shift(df1, jump, along, w, max_freq, per_gene = fft == 'genes')
+        pairs['fft_shift'] = shift[::-1] if along == 'y' else shift
+
+    return(pairs)
+
+
+def confirm_band(pairs, max_freq, minMode, merge_dist = 3, max_multdist = 20):
+    ''' Finds the duplicated transcripts of one gridline band from its potential pairs (see band_pairs): pairs of 
+    genes with more than max_freq transcripts in the band are left out, the XYZ shift is their mode (see mode3D) and 
+    duplicates are mutual best partners closer than max_multdist once shifted. Cheap, so it can be re-run with other 
+    thresholds on the same pairs.
+    Returns the original indices of the duplicated transcripts (first side of the line), the XYZ shift, 
+    the duplicated pairs as x1,x2,y1,y2 rows (for plotting) and the number of potential partner pairs'''
+
+    # Filter out too common genes
+    rare = pairs['gene_count'] <= max_freq
+    pi, pj, pair_dists = pairs['i'][rare], pairs['j'][rare], pairs['dists'][rare]
+    first, x, y = pairs['first'], pairs['x'], pairs['y']
+
+    # Find mode of XYZ shift between potential duplicates
+    shift = mode3D(*pair_dists.T, minMode, merge_dist)
+    duplicated = np.array([], dtype = int)
+
+    # If there is a shift 
+    if max(shift) > 2:
+
+        #### Confirm real duplications by mutual best partner and max distance #####
+        best, best_multdist = best_partners(len(first), pi, pj, pair_dists, shift)
+
+        # multdist is distance multiplied by weight vector [6,6,1], so Z variation is 6 times less relevant than XY variation
+        candidates = np.flatnonzero(first & (best >= 0))
+        mutual = best[best[candidates]] == candidates
+        duplicated = candidates[mutual & (best_multdist[candidates] < max_multdist)]
+
+    segments = np.c_[x[duplicated], x[best[duplicated]], y[duplicated], y[best[duplicated]]] if len(duplicated) else np.empty((0, 4))
+
+    return(pairs['index'][duplicated], shift, segments, len(pi))
+
+
+def pair_index_folder(path_file, w, Xtilesize, Ytilesize, fft = None, max_freq = None):
+    ''' Folder of the potential pair index of an input for one band geometry (next to the binary cache of read_transcripts).
+    Indices with FFT shift estimates are kept apart, as the estimates also depend on max_freq'''
+
+    name = f'pairs_w{w}_{Xtilesize}x{Ytilesize}' + (f'_fft{fft}{max_freq}' if fft else '')
+    return(os.path.join(path_file + '.cache', name))
+
+
+def input_stamp(path_file):
+    ''' Size and modification time of an input, to tell if caches were made from it'''
+
+    return(dict(size = os.path.getsize(path_file), mtime = os.path.getmtime(path_file)))
+
+
+def load_pair_index(folder, path_file):
+    ''' Bands (plot rectangle, text position, minimum duplicates) and number of input rows of a complete pair 
+    index made from this input, None if there is none'''
+
+    try:
+        with open(os.path.join(folder, 'meta.json')) as f: meta = json.load(f)
+    except (OSError, ValueError):
+        return(None)
+
+    return(meta if meta['stamp'] == input_stamp(path_file) else None)
+
+
+def save_band_pairs(folder, n, pairs):
+    ''' Saves the potential pairs of band number n in the pair index'''
+
+    np.savez(os.path.join(folder, f'band{n}.npz'), **pairs)
+
+
+def load_band_pairs(folder, n):
+    ''' Potential pairs of band number n from the pair index'''
+
+    with np.load(os.path.join(folder, f'band{n}.npz')) as f: return(dict(f))
+
+
+def finish_pair_index(folder, path_file, bands, nrows):
+    ''' Marks a pair index as complete (written after all bands, so an interrupted run is never reused)'''
+
+    with open(os.path.join(folder, 'meta.json'), 'w') as f: 
+        json.dump(dict(stamp = input_stamp(path_file), bands = bands, nrows = int(nrows)), f, default = int)
+
+
+###########################   MAIN  ##############################################
 
-                #### Confirm real duplications by mutual best partner and max distance #####
-                for i in df1.index[bottom]:
-                    
-                    p1 = pointi(i,shift)
-                    bp1 = p1.best_partner
-                    
-                    if bp1:
-                        p2 = pointi(bp1,shift)
-                        bp2 = p2.best_partner
                         
-                        if i == bp2 and p1.best_multdist < 20:   # multdist is distance multiplied by weight vector [6,6,1], so Z variation is 6 times less relevant than XY variation
-                            dups  +=1 
-                            duplicated.append(i)
+if __name__ == '__main__':
+    import os,glob, argparse
+    import matplotlib.pyplot as plt
+
+    parser = argparse.ArgumentParser(description = 'Takes a single XYZ_coordinates.txt file and searches for duplicates along grid happening at every 2144 pixels')
+    parser.add_argument("input", help="Input gene xyz coordinates file")
+    parser.add_argument("Xtilesize", nargs = '?', type=int, default = 2144,  help="Tile size (distance between gridlines) on X axis")
+    parser.add_argument("Ytilesize", nargs = '?', type=int, default = None,  help="Tile size (distance between gridlines) on Y axis")
+    parser.add_argument("windowsize", nargs = '?', type=int, default = 30,  help="Window arround gridlines to search for duplicates")
+    parser.add_argument("maxfreq", nargs = '?', type=int, default = 400,  help="Maximum transcript count to calculate X/Y shifts (better to discard very common genes)")
+    parser.add_argument("minMode", nargs = '?', type=int, default = 10,  help="Minumum occurances of ~XYZ_shift to consider it valid")
+    parser.add_argument("-w", "--workers", type=int, default = 1,  help="Number of gridline bands processed in parallel (processes)")
+    parser.add_argument("-o", "--output", choices = ['text', 'flags', 'both'], default = 'text',  help="'text' rewrites the input with duplicates named 'Duplicated' (_markedDups.txt), 'flags' only saves one boolean per row (_duplicated.npy)")
+    parser.add_argument("--no-cache", action = 'store_true', default = False,  help="Do not read or write the binary copy of the input and the potential pair index (<input>.cache) that make reruns skip parsing and partner search")
+    parser.add_argument("-s", "--stream", nargs = '?', type=int, const = 2000000, default = None,  help="Out-of-core: read the input in chunks of this many rows (default 2000000) into spill files per gridline band and process one band at a time")
+    parser.add_argument("--merge-dist", type=int, default = 3,  help="XYZ shifts closer than this (sum of XYZ differences) to the mode count towards it")
+    parser.add_argument("--max-multdist", type=int, default = 20,  help="Maximum shift corrected distance of duplicates (XY weighted 6 times Z)")
+    parser.add_argument("--fft", choices = ['genes', 'pooled'], default = None,  help="Also estimate the XY shift of every band by FFT cross-correlation of per gene density grids ('pooled': all genes in one grid) and print it with its confidence next to the mode shift (duplicates do not change)")
+    parser.add_argument("-p", "--plot", default = None,  help="Illustrative lineplot of duplicated pairs with annotated XYZ shift per tileOvlap")
+    args=parser.parse_args()
+
+    # Sanity checks of input
+    pathname, extension = os.path.splitext(args.input)
 
-                            # Plot line between point pair if asked for
-                            if args.plot: 
-                                plt.plot([p1.point.x, p2.point.x],
-                                    [p1.point.y, p2.point.y], c = 'red', linewidth = 0.2 )
+    if os.path.exists(args.input) == False:
+        print("Input file does not exist!"); exit()
+
+    # Prepare parameters 
+    w = args.windowsize
+    minMode = args.minMode
+    max_freq = args.maxfreq
+    Xtilesize = args.Xtilesize #2144
+    Ytilesize = args.Xtilesize if args.Ytilesize == None else args.Ytilesize 
+    duplicated = [] 
+    tileOvlaps, totalDups, tilePairs = 0, 0, 0
 
-                # Count Tiles as overlapping if least 10 duplicated points 
-                if dups > 9: 
-                    totalDups += dups
-                    tileOvlaps +=1 
-                    #print(xmin,xmax, ymin,ymax, pNUM, len(duplicated))            
+    # Potential pairs only depend on geometry: reuse the pair index of an earlier run with the same windowsize and tile sizes
+    fft = dict(fft = args.fft, max_freq = max_freq) if args.fft else {}
+    index = None if args.no_cache else pair_index_folder(args.input, w, Xtilesize, Ytilesize, **fft)
+    reused = load_pair_index(index, args.input) if index else None
+
+    if reused:
+        print(f'Reusing potential pairs of {index}')
+        bands, nrows = reused['bands'], reused['nrows']
+        results = (load_band_pairs(index, n) for n in range(len(bands)))
+        if not args.stream: df = read_transcripts(args.input)
+
+    else:
+        if args.stream:
+            # Out-of-core: transcripts of every gridline band go to spill files, each band is read when processed
+            import tempfile
+            spill_folder = tempfile.TemporaryDirectory(dir = os.path.dirname(os.path.abspath(args.input)))
+            spilled, nrows, panoXmax, panoYmax, genes = spill_bands(args.input, Xtilesize, Ytilesize, w, spill_folder.name, args.stream)
+
+            vertical_bands = {k[1:]: path for k, path in spilled.items() if k[0] == 'vertical'}
+            horizontal_bands = {k[1:]: path for k, path in spilled.items() if k[0] == 'horizontal'}
+            band_table = lambda path: path
+            band_duplicates = partial(spilled_band_pairs, genes = genes, **fft)
+        else:
+            # Read input (compact columns, from the binary cache when there is one)
+            df = read_transcripts(args.input, cache = not args.no_cache)
+            panoYmax, panoXmax = df.y.max(), df.x.max()
+
+            # Transcripts of every gridline band, sorted along the line (one pass over the table)
+            vertical_bands = gridline_bands(df.x.values, df.y.values, Xtilesize, Ytilesize, w, panoXmax)
+            horizontal_bands = gridline_bands(df.y.values, df.x.values, Ytilesize, Xtilesize, w, panoYmax)
+            band_table = lambda rows: df.iloc[rows].reset_index()
+            band_duplicates = partial(band_pairs, **fft)
+            nrows = len(df)
+
+        # Every gridline band with transcripts is one unit of work: first vertical lines, then horizontal lines
+        bands, jobs = [], []
+
+        for yjump in range(0, panoYmax, Ytilesize):
+            ymin,ymax = yjump,yjump + Ytilesize
+
+            for xjump in range(Xtilesize, panoXmax, Xtilesize):
+                xmin,xmax = xjump - w, xjump + w
+
+                # Points of only one grid line (already sorted along it)
+                rows = vertical_bands.get((yjump // Ytilesize, xjump // Xtilesize))
+
+                # Skip rest if no transcripts exist 
+                if rows is None:
+                    print(f'Found no transcripts within Y{xmin}:{xmax}, X{ymin}:{ymax}')
+                    continue     
+
+                # Tileoverlap counts with at least 5 duplicated points (text annotation left of the band)
+                bands.append(((xmin, ymin, 2*w, ymax - ymin), (xmin-400, ymin+1000), 4))
+                jobs.append((rows, xjump, 'y'))
+
+        for xjump in range(0, panoXmax, Xtilesize):
+            xmin,xmax = xjump,xjump + Xtilesize
+
+            for yjump in range(Ytilesize, panoYmax, Ytilesize):
+                ymin,ymax = yjump -w, yjump + w
+
+                rows = horizontal_bands.get((xjump // Xtilesize, yjump // Ytilesize))
+
+                if rows is None:
+                    print(f'Found no transcripts within Y{xmin}:{xmax}, X{ymin}:{ymax}')
+                    continue  
+
+                # Tileoverlap counts with at least 10 duplicated points (text annotation above the band)
+                bands.append(((xmin, ymin, xmax - xmin, 2*w), (xmin+1000, ymin-100), 9))
+                jobs.append((rows, yjump, 'x'))
+
+        # Find the pairs of every band (in parallel if asked), results come back in band order whatever the number of workers
+        # Band tables are built one at a time as bands are handed out, not all before the first one is processed
+        band_args = [(band_table(rows) for rows, jump, along in jobs), [jump for rows, jump, along in jobs], 
+                     [along for rows, jump, along in jobs], [w] * len(jobs)]
+
+        if args.workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(args.workers)
+            results = pool.map(band_duplicates, *band_args, chunksize = max(1, len(jobs) // (4 * args.workers)))
+        else:
+            results = map(band_duplicates, *band_args)
+
+        if index:
+            shutil.rmtree(index, ignore_errors = True) ; os.makedirs(index)
+
+    # Shift and duplicates of every band from its pairs (cheap), saving the pairs for later runs
+    for n, ((rectangle, text_xy, min_dups), pairs) in enumerate(zip(bands, results)):
+        if index and not reused: save_band_pairs(index, n, pairs)
+        band_dups, shift, segments, npairs = confirm_band(pairs, max_freq, minMode, args.merge_dist, args.max_multdist)
+        tilePairs +=1 
+        duplicated.append(band_dups)
+
+        if 'confidence' in pairs:
+            print(f'Band X{rectangle[0]} Y{rectangle[1]}: XYZ shift {shift}, FFT XY shift {np.round(pairs["fft_shift"], 1)} (confidence {float(pairs["confidence"]):.1f})')
+
+        if args.plot: # Plot gridlines, annotate XYZ shift between tiles and line between duplicated pairs
+            plt.gca().add_patch(plt.Rectangle(rectangle[:2], *rectangle[2:], fill=False, ec="grey", linewidth = 0.3))
+            plt.text(*text_xy, str(shift), size = 4)
+            for x1, x2, y1, y2 in segments:
+                plt.plot([x1, x2], [y1, y2], c = 'red', linewidth = 0.2 )
+
+        # Count Tileoverlap with enough duplicated points
+        if len(band_dups) > min_dups: 
+            totalDups += len(band_dups)
+            tileOvlaps +=1 
+
+    if not reused:
+        if args.workers > 1: pool.shutdown()
+        if args.stream: spill_folder.cleanup()
+        if index: finish_pair_index(index, args.input, bands, nrows)
 
     if args.plot: 
         plt.xlabel('X') #;  plt.xlim([df.x.min(), df.x.max()])
@@ -399,9 +721,12 @@ if __name__ == '__main__':
         plt.gca().invert_yaxis()
         plt.savefig('XYZshift_visualization.png', dpi = 550)
 
-    # Replace Gene name by Duplicated and write new XYZ.txt file 
-    df.loc[duplicated, 'gene'] = 'Duplicated'
-    df.to_csv(pathname + '_markedDups.txt', sep = '\t', header=None, index = False )
+    # Mark duplicates as a rewritten XYZ.txt file and/or a flag per row
+    duplicated = np.concatenate(duplicated) if duplicated else np.array([], dtype = np.int64)
+    if args.stream:
+        write_duplicates_streamed(args.input, duplicated, pathname, args.output, nrows, args.stream)
+    else:
+        write_duplicates(df, duplicated, pathname, args.output)
 
 
     # Counts for analysis: Number of tile pairs, number of tile overlaps, total duplicated transcripts
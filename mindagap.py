@@ -1,6 +1,8 @@
-doc = ''' USAGE:   python mindagap.py  <PANORAMA.tif> <boxsize> <loopnum> -xt <Xtilesize> -yt <Ytilesize> --edges <True|False> 
+doc = ''' USAGE:   python mindagap.py  <PANORAMA.tif> [<PANORAMA2.tif> <DIR> <'GLOB*.tif'> ...] <boxsize> <loopnum> -xt <Xtilesize> -yt <Ytilesize> --edges <True|False> 
 
-   Takes a single panorama image and fills the empty grid lines with neighbour-weighted values.
+   Takes panorama images and fills the empty grid lines with neighbour-weighted values.
+   Several files, directories or glob patterns are processed in one run. 
+   Can also be imported:  import mindagap ; filled = mindagap.fill_grids(img_array, box_size = 5, nloops = 40)
    
    Small boxsize yields limited results but works the best with a high loop number (like 20)
    Increase boxsize to overcome bigger gaps 
@@ -13,9 +15,94 @@ doc = ''' USAGE:   python mindagap.py  <PANORAMA.tif> <boxsize> <loopnum> -xt <X
     Ricardo Guerreiro
     Resolve Biosciences'''      
 
+import os, glob, hashlib, tempfile, time, threading
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+#increase max allowed image size (before OpenCV is loaded)
+os.environ.setdefault("OPENCV_IO_MAX_IMAGE_PIXELS", pow(2,40).__str__())
+import cv2
+
+# tifffile, rich, scipy, zarr and pyamg are only imported by the functions that need them
+version_number = "0.0.4"
+
+
+# Stage records while instrumentation is on (see record_stages), None otherwise
+stage_log, stage_start = None, 0.0
+
+
+def record_stages(on = True):
+    ''' Starts (or stops) recording wall time, CPU time and memory of every processing stage (read, mask, 
+    edges, each round, write...). Returns the list the stage records are appended to.'''
+    global stage_log, stage_start
+
+    stage_log, stage_start = ([] if on else None), time.perf_counter()
+    return(stage_log)
+
+
+def memory_mb():
+    ''' Current and peak resident memory of the process in MB (None where the OS does not tell)'''
+
+    try:
+        with open('/proc/self/statm') as f: current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        current = None
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if os.uname().sysname == 'Darwin' else 2**10)
+    except ImportError:
+        peak = None
+
+    return(current, peak)
+
+
+@contextmanager
+def stage(name, **fields):
+    ''' Records the wall time, CPU time (of the whole process, overlapping when layers run in parallel) and 
+    memory of the enclosed code as stage <name> with extra <fields>, when recording is on (see record_stages)'''
+
+    if stage_log is None: 
+        yield ; return
+
+    wall, cpu, (rss, _) = time.perf_counter(), time.process_time(), memory_mb()
+    try:
+        yield
+    finally:
+        end_rss, peak = memory_mb()
+        stage_log.append(dict(stage = name, **fields, thread = threading.current_thread().name, start_s = wall - stage_start,
+                              wall_s = time.perf_counter() - wall, cpu_s = time.process_time() - cpu, 
+                              rss_mb = end_rss, rss_change_mb = None if rss is None else end_rss - rss, peak_rss_mb = peak))
+
+
+def save_stages(path_file, records = None):
+    ''' Writes stage records as JSON, or as CSV when path_file ends in .csv, and prints the time and 
+    peak memory of each stage'''
+
+    records = stage_log if records is None else records
+
+    if path_file.endswith('.csv'):
+        import csv
+        columns = list(dict.fromkeys(k for record in records for k in record))
+        with open(path_file, 'w', newline = '') as f:
+            table = csv.DictWriter(f, columns) ; table.writeheader() ; table.writerows(records)
+    else:
+        import json
+        with open(path_file, 'w') as f: json.dump(dict(version = version_number, stages = records), f, indent = 1, default = str)
+
+    for name in dict.fromkeys(record['stage'] for record in records):
+        these = [record for record in records if record['stage'] == name]
+        peak = max((record['peak_rss_mb'] or 0) for record in these)
+        print(f"{name:>12}: {len(these):5d} x  {sum(r['wall_s'] for r in these):9.2f} s wall  {sum(r['cpu_s'] for r in these):9.2f} s CPU  {peak:8.0f} MB peak")
+    print(f'Saving: {path_file}')
+
+
     
 def read_img(path_file):
     ''' Reads a tiff/png image into a numpy array'''
+    import tifffile
     
     pathname, extension = os.path.splitext(path_file)
 
@@ -26,90 +113,957 @@ def read_img(path_file):
             return(0)
 
         # Read input as tif file or as png/jpg
-        if extension[1:4] == 'tif':
-            img = tifffile.imread(path_file) 
-        else:
-            img = cv2.imread(path_file,cv2.IMREAD_UNCHANGED) 
+        with stage('read', file = path_file):
+            if extension[1:4] == 'tif':
+                img = tifffile.imread(path_file) 
+            else:
+                img = cv2.imread(path_file,cv2.IMREAD_UNCHANGED) 
 
         return(img)
     except: 
         print(f"Input file invalid: \n {path_file}") 
 
 
-def fill_grids(img_array, box_size = 5, nloops = 1, edges = 0, Xtilesize = None):
+def load_img(path_file):
+    ''' read_img that raises FileNotFoundError for a missing file and ValueError for an unreadable one'''
+
+    if not os.path.exists(path_file):
+        raise FileNotFoundError(f"Input file does not exist: {path_file}")
+
+    img = read_img(path_file)
+    if not isinstance(img, np.ndarray):
+        raise ValueError(f"Input file invalid: {path_file}")
+
+    return(img)
+
+
+def open_img(path_file):
+    ''' Opens a tif panorama without loading it into memory: as a memory map when the file is uncompressed 
+    and contiguous, otherwise as a zarr array that decodes one tile/strip at a time (needs zarr)'''
+    import tifffile
+
+    try:
+        return(tifffile.memmap(path_file, mode = 'r'))
+    except ValueError:
+        pass
+
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError(f"{path_file} is compressed or not contiguous, reading it out-of-core needs zarr (pip install zarr)")
+
+    img = zarr.open(tifffile.imread(path_file, aszarr = True), mode = 'r')
+    if not hasattr(img, 'shape'): img = img[0]   # Pyramidal files open as a group, first level is full resolution
+
+    return(img)
+
+
+def write_img(path_file, img, ome = None):
+    ''' Writes a numpy array as tif or png/jpg, depending on the extension. 
+    With ome (a dict of write_ome options, can be empty) writes a tiled pyramidal OME-TIFF instead'''
+
+    if ome is not None:
+        write_ome(path_file, img, **ome)
+    elif 'tif' in os.path.splitext(path_file)[1]:
+        import tifffile
+        with stage('write', file = path_file): tifffile.imwrite(path_file, img)
+    else:
+        with stage('write', file = path_file): cv2.imwrite(path_file, img)
+
+
+def output_name(path_file, ome = None):
+    ''' Output path for a panorama: <name>_gridfilled.<ext>, or <name>_gridfilled.ome.tif for OME-TIFF output'''
+
+    pathname, extension = os.path.splitext(path_file)
+    if ome is None: return(pathname + '_gridfilled' + extension)
+
+    return(pathname[:-4] if pathname.endswith('.ome') else pathname) + '_gridfilled.ome.tif'
+
+
+def downsample(src, tile = 512, folder = None):
+    ''' Halves a 2D/3D image tile by tile (pixels averaged). The result is kept in memory, or in a 
+    temporary memory map inside <folder> when given, so big panoramas never have to fit in RAM.'''
+
+    shape = src.shape[:-2] + ((src.shape[-2] + 1) // 2, (src.shape[-1] + 1) // 2)
+    if folder is None:
+        out = np.empty(shape, dtype = src.dtype)
+    else:
+        out = np.memmap(os.path.join(folder, f'level{len(os.listdir(folder))}.raw'), dtype = src.dtype, mode = 'w+', shape = shape)
+
+    for layer in np.ndindex(src.shape[:-2]):
+        for y in range(0, shape[-2], tile):
+            for x in range(0, shape[-1], tile):
+                block = np.asarray(src[layer + (slice(2 * y, 2 * (y + tile)), slice(2 * x, 2 * (x + tile)))])
+                h, w = min(tile, shape[-2] - y), min(tile, shape[-1] - x)
+                out[layer + (slice(y, y + h), slice(x, x + w))] = cv2.resize(block, (w, h), interpolation = cv2.INTER_AREA)
+
+    return(out)
+
+
+def write_ome(path_file, img, tile = 512, compression = 'zlib', levels = None, workers = None):
+    ''' Writes a 2D (YX) or 3D (ZYX) image as a tiled, compressed, pyramidal OME-TIFF: full resolution plus 
+    <levels> halvings as SubIFDs (default: until the image fits in one tile). Tiles are streamed to the 
+    writer and compressed with <workers> threads (None lets tifffile choose, 'zstd' compression needs imagecodecs). When img is a 
+    memory map the lower resolutions are built in temporary memory maps next to the output.'''
+
+    import tifffile
+
+    if levels is None: 
+        levels = max(0, int(np.ceil(np.log2(max(img.shape[-2:]) / tile))))
+    metadata = {'axes': 'YX' if len(img.shape) == 2 else 'ZYX'}
+    options = dict(tile = (tile, tile), compression = None if compression == 'none' else compression, maxworkers = workers)
+
+    def tiles(data):
+        for layer in np.ndindex(data.shape[:-2]):
+            for y in range(0, data.shape[-2], tile):
+                for x in range(0, data.shape[-1], tile):
+                    block = np.asarray(data[layer + (slice(y, y + tile), slice(x, x + tile))])
+                    yield np.pad(block, ((0, tile - block.shape[0]), (0, tile - block.shape[1])))
+
+    with stage('write ome', file = path_file), tempfile.TemporaryDirectory(dir = os.path.dirname(os.path.abspath(path_file))) as folder:
+        on_disk = folder if isinstance(img, np.memmap) else None
+
+        with tifffile.TiffWriter(path_file, bigtiff = True, ome = True) as tif:
+            tif.write(tiles(img), shape = img.shape, dtype = img.dtype, subifds = levels, metadata = metadata, **options)
+
+            level = img
+            for l in range(levels):
+                level = downsample(level, tile, on_disk)
+                tif.write(tiles(level), shape = level.shape, dtype = level.dtype, subfiletype = 1, **options)
+            del level
+
+
+def progress_range(n, description, show = True):
+    ''' range(n), with a rich progress bar if show'''
+
+    if not show: return(range(n))
+
+    from rich.progress import track
+    return(track(range(n), description = description))
+
+
+def min_nonzero(img, layer = None, rows = 1024):
+    ''' Minimum non-zero pixel value of a (possibly memory mapped) image or of one of its layers, read in blocks of rows'''
+
+    low = None
+    for y in range(0, img.shape[-2], rows):
+        block = np.asarray(img[y:y + rows] if layer is None else img[layer, y:y + rows])
+        block = block[block > 0]
+        if block.size: low = block.min() if low is None else min(low, block.min())
+
+    return(low)
+
+
+def fill_tiled(src, out, tile = 4096, layer = None, **params):
+    ''' Runs fill_grids over a panorama tile by tile, reading from <src> and writing to <out> (memory maps or 
+    zarr arrays, <layer> selects a z-layer of 3D ones), so only one padded tile is in memory at a time.
+    Tiles are padded by how far values travel over all blur rounds, so seams match a whole-image fill.
+    Tiles without gaps are copied as they are. A gridline index in params is cropped to each tile, 
+    tile borders (Xtilesize) and the harmonic and pyramid methods (whose fill depends on the whole gap) are not supported.'''
+
+    if params.get('method', 'blur') != 'blur':
+        raise ValueError("Only the blur method can be filled tile by tile")
+
+    at = (lambda ys, xs: (ys, xs)) if layer is None else (lambda ys, xs: (layer, ys, xs))
+    lines = params.pop('lines', None)
+    height, width = src.shape[-2:]
+    fill_value = min_nonzero(src, layer)
+
+    halo = params.get('nloops', 1) * (params.get('box_size', 5) // 2) + int(params.get('edges', 0))
+
+    for y0 in range(0, height, tile):
+        print(f'Filling tile row {y0 // tile + 1} of {-(-height // tile)}')
+
+        for x0 in range(0, width, tile):
+            y1, x1 = min(y0 + tile, height), min(x0 + tile, width)
+            py0, px0 = max(y0 - halo, 0), max(x0 - halo, 0)
+
+            window = np.asarray(src[at(slice(py0, min(y1 + halo, height)), slice(px0, min(x1 + halo, width)))])
+            if not window.all(): 
+                window_lines = None if lines is None else crop_lines(lines, py0, py0 + window.shape[0], px0, px0 + window.shape[1])
+                window = fill_grids(window, fill_value = fill_value, lines = window_lines, progress = False, **params)
+
+            out[at(slice(y0, y1), slice(x0, x1))] = window[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+
+    return(out)
+
+
+def runs(flags):
+    ''' Start and stop indices of the stretches of True values in a 1D boolean array'''
+
+    steps = np.diff(np.concatenate(([0], np.asarray(flags, dtype=np.int8), [0])))
+    return(np.flatnonzero(steps == 1), np.flatnonzero(steps == -1))
+
+
+def gap_rects(mask, halo, min_line = 64):
+    ''' Rectangles (rows y0:y1, columns x0:x1 as an n x 4 array) covering all pixels of a gap mask, 
+    stretches closer than 2 * halo merged. 
+
+    Rows crossed by a horizontal gridline (a run of at least <min_line> gap pixels) are grouped apart 
+    from the rows in between, so vertical gridlines become thin strips instead of whole-image bands.'''
+
+    height, width = mask.shape
+    mask8 = mask.view(np.uint8)
+
+    # Row classes: 0 no gaps, 1 gaps only (vertical lines or spots), 2 crossed by a horizontal line
+    hline = cv2.morphologyEx(mask8, cv2.MORPH_OPEN, np.ones((1, min(min_line, width)), np.uint8))
+    row_class = mask8.any(axis=1).astype(np.int8) + hline.any(axis=1)
+
+    rects = []
+    bounds = np.flatnonzero(np.diff(row_class)) + 1
+    for r0, r1 in zip(np.r_[0, bounds], np.r_[bounds, height]):
+        if row_class[r0] == 0: continue 
+
+        # Column stretches with gaps in this group of rows, merged when their halos would overlap
+        starts, stops = runs(mask8[r0:r1].any(axis=0))
+        keep = np.r_[True, starts[1:] - stops[:-1] > 2 * halo]
+        starts, stops = starts[keep], stops[np.r_[keep[1:], True]]
+
+        rects += [(r0, r1, c0, c1) for c0, c1 in zip(starts, stops)]
+
+    return(np.array(rects, dtype = np.int64).reshape(-1, 4))
+
+
+def pad_rects(rects, shape, halo):
+    ''' Rectangles grown by <halo> on every side and clipped to the image'''
+
+    height, width = shape
+    return(np.clip(rects + [-halo, halo, -halo, halo], 0, [height, height, width, width]))
+
+
+def rect_strips(rects, shape, halo):
+    ''' Strips from an n x 4 array of rectangles: a list of (core, padded, inner) slice pairs, core covers a rectangle, 
+    padded is core plus a halo of <halo> pixels (clipped at the image border) and inner locates core within padded'''
+
+    strips = []
+    for (y0, y1, x0, x1), (py0, py1, px0, px1) in zip(pad_rects(rects, shape, 0), pad_rects(rects, shape, halo)):
+
+        strips.append(((slice(y0, y1), slice(x0, x1)),
+                       (slice(py0, py1), slice(px0, px1)),
+                       (slice(y0 - py0, y1 - py0), slice(x0 - px0, x1 - px0))))
+    return(strips)
+
+
+def dilate_strips(mask, strips, size):
+    ''' Dilates a gap mask with a size x size square (same pixels as a convolution in 'same' mode), strip by 
+    strip on uint8 crops. Strips must be padded by <size>, so each holds the whole dilation of its core.'''
+
+    kernel = np.ones((size, size), np.uint8)
+    mask8 = mask.view(np.uint8)
+    expanded = np.zeros(mask.shape, dtype = bool)
+
+    for core, padded, inner in strips:
+        expanded[padded] |= cv2.dilate(mask8[padded], kernel).view(bool)
+
+    return(expanded)
+
+
+def band_round(im, mask, strips, blur):
+    ''' One fill round restricted to gap strips: blurs every padded strip of <im> first, then copies 
+    the blurred values into the gap pixels, so all strips read the same state as a full-frame blur.'''
+
+    strips = [s for s in strips if mask[s[0]].any()]   # Strips without pixels left to fill are skipped
+    blurred = [blur(im[padded]) for core, padded, inner in strips]
+
+    for (core, padded, inner), blur_img in zip(strips, blurred):
+        gaps = mask[core]
+        im[core][gaps] = blur_img[inner][gaps]
+
+
+GridLine = namedtuple('GridLine', ['axis', 'offset', 'width', 'start', 'stop'])
+GridLine.__doc__ = ''' Gridline segment: axis 'x' is a vertical line over columns offset:offset+width and rows start:stop, 
+axis 'y' a horizontal line over rows offset:offset+width and columns start:stop'''
+
+
+def line_slices(line):
+    ''' Image slices covered by a GridLine'''
+
+    across, along = slice(line.offset, line.offset + line.width), slice(line.start, line.stop)
+    return((along, across) if line.axis == 'x' else (across, along))
+
+
+def tile_gridlines(shape, Xtilesize, Ytilesize = None):
+    ''' Gridlines between tiles of known size: 3 pixels around every multiple of the tile size'''
+
+    height, width = shape[-2:]
+    Ytilesize = Ytilesize or Xtilesize
+
+    return([GridLine('x', xjump - 1, 3, 0, height) for xjump in range(Xtilesize, width, Xtilesize)] + 
+           [GridLine('y', yjump - 1, 3, 0, width) for yjump in range(Ytilesize, height, Ytilesize)])
+
+
+def detect_gridlines(img, layer = None, min_frac = 0.5, min_length = 16, rows = 1024):
+    ''' Finds gridlines from the number of zero pixels in every column and row of an image or of one of its
+    layers (read in blocks of rows, so memory maps and zarr arrays stay on disk). Neighbouring columns/rows that are zero over at least min_frac of the image 
+    make a line, split into the segments along it that hold zeros (segments shorter than min_length dropped).
+    Returns the GridLine segments and the tile pitch (median distance between lines) on X and Y, or None.'''
+
+    at = (lambda ys, xs: (ys, xs)) if layer is None else (lambda ys, xs: (layer, ys, xs))
+    height, width = img.shape[-2:]
+    col_zeros, row_zeros = np.zeros(width, dtype = np.int64), np.zeros(height, dtype = np.int64)
+
+    for y in range(0, height, rows):
+        block = np.asarray(img[at(slice(y, y + rows), slice(None))]) == 0
+        col_zeros += block.sum(axis = 0)
+        row_zeros[y:y + rows] = block.sum(axis = 1)
+
+    lines, pitch = [], []
+    for axis, zeros, length in [('x', col_zeros, height), ('y', row_zeros, width)]:
+        starts, stops = runs(zeros >= min_frac * length)
+
+        for a, b in zip(starts, stops):
+            band = np.asarray(img[at(slice(None), slice(a, b)) if axis == 'x' else at(slice(a, b), slice(None))]) == 0
+            for s, e in zip(*runs(band.any(axis = 1 if axis == 'x' else 0))):
+                if e - s >= min_length: lines.append(GridLine(axis, int(a), int(b - a), int(s), int(e)))
+
+        pitch.append(float(np.median(np.diff(starts))) if len(starts) > 1 else None)
+
+    return(lines, tuple(pitch))
+
+
+def crop_lines(lines, y0, y1, x0, x1):
+    ''' GridLines that cross the window y0:y1, x0:x1, in window coordinates'''
+
+    cropped = []
+    for axis, offset, width, start, stop in lines:
+        (a0, a1), (b0, b1) = ((x0, x1), (y0, y1)) if axis == 'x' else ((y0, y1), (x0, x1))
+        if offset + width > a0 and offset < a1 and stop > b0 and start < b1:
+            cropped.append(GridLine(axis, max(offset - a0, 0), min(offset + width, a1) - max(offset, a0), 
+                                    max(start - b0, 0), min(stop, b1) - b0))
+    return(cropped)
+
+
+def line_mask(img, lines):
+    ''' Gap mask of a 2D image restricted to a gridline index: only its zero pixels on the lines'''
+
+    mask = np.zeros(img.shape, dtype = bool)
+    for line in lines: mask[line_slices(line)] = img[line_slices(line)] == 0
+
+    return(mask)
+
+
+def line_rects(lines):
+    ''' Rectangles (n x 4 array like gap_rects) covered by GridLines'''
+
+    rects = [(ys.start, ys.stop, xs.start, xs.stop) for ys, xs in map(line_slices, lines)]
+    return(np.array(rects, dtype = np.int64).reshape(-1, 4))
+
+
+class GapCache:
+    ''' On-disk cache of what is derived from a gap mask (strips, dilated edges, gap regions), shared by every 
+    image with the same shape and zero pattern, like the channels and rounds of one acquisition. 
+    One .npz file per mask, the least recently used ones are deleted once the folder exceeds max_mb.'''
+
+    def __init__(self, folder, mask, max_mb = 2048):
+        self.folder, self.max_bytes = folder, max_mb * 2**20
+        digest = hashlib.blake2b(np.packbits(mask).tobytes(), digest_size = 16).hexdigest()
+        self.path = os.path.join(folder, f'{mask.shape[0]}x{mask.shape[1]}_{digest}.npz')
+        self.entries, self.changed = {}, False
+
+        if os.path.exists(self.path):
+            with np.load(self.path) as saved: self.entries = dict(saved)
+            os.utime(self.path)   # Mark as recently used
+
+    def get(self, name, compute):
+        ''' Cached array(s) under name, computed (and kept for saving) if missing'''
+
+        if name in self.entries: return(self.entries[name])
+
+        parts = sorted((k for k in self.entries if k.startswith(name + '.')), key = lambda k: int(k.split('.')[-1]))
+        if parts: return(tuple(self.entries[k] for k in parts))
+
+        value = compute()
+        if isinstance(value, tuple): self.entries.update({f'{name}.{i}': v for i, v in enumerate(value)})
+        else: self.entries[name] = value
+        self.changed = True
+
+        return(value)
+
+    def save(self):
+        ''' Writes new entries (atomically, other processes may read the same file) and evicts old files'''
+
+        if not self.changed: return
+        os.makedirs(self.folder, exist_ok = True)
+
+        # Unique temporary name per writer (threads of one process may save the same mask)
+        handle, tmp = tempfile.mkstemp(dir = self.folder, suffix = '.tmp.npz')
+        os.close(handle)
+        np.savez(tmp, **self.entries)
+        os.replace(tmp, self.path)
+        self.changed = False
+
+        # Evict finished cache files only (others may be written or removed meanwhile)
+        sizes = {}
+        for f in glob.glob(os.path.join(self.folder, '*x*_*.npz')):
+            if f.endswith('.tmp.npz'): continue
+            try: sizes[f] = (os.path.getmtime(f), os.path.getsize(f))
+            except OSError: pass
+
+        total = sum(size for mtime, size in sizes.values())
+        for f in sorted(sizes, key = lambda f: sizes[f][0]):
+            if total <= self.max_bytes or f == self.path: continue
+            total -= sizes[f][1]
+            try: os.remove(f)
+            except OSError: pass
+
+
+def gap_regions(mask):
+    ''' Flat indices of the gap pixels grouped by connected gap region, and the start of each region in them'''
+
+    nregions, labels = cv2.connectedComponents(mask.view(np.uint8), connectivity = 8)
+    gap_idx = np.flatnonzero(mask)
+    region = labels.ravel()[gap_idx]
+    order = np.argsort(region, kind = 'stable')
+
+    return(gap_idx[order], np.searchsorted(region[order], np.arange(1, nregions)))
+
+
+def harmonic_fill(im, mask, solver = 'cg'):
+    ''' Fills the gap pixels of <im> in place with the solution of Laplace's equation (each gap pixel is the 
+    mean of its 4 neighbours), known pixels around the gaps being the boundary. This is what repeated 
+    blurring converges to, solved at once with a sparse system over the gap pixels only.
+    solver: 'direct' (sparse LU), 'cg' (conjugate gradient, direct solve if it does not converge) or 'amg' (algebraic multigrid, needs pyamg, best for wide gaps)'''
+
+    from scipy import sparse
+    from scipy.sparse.linalg import spsolve, cg
+
+    height, width = mask.shape
+    flat_im, flat_mask = im.ravel(), mask.ravel()
+    gap_idx = np.flatnonzero(flat_mask)
+    n = len(gap_idx)
+    if n == 0: return(im)
+
+    rows, cols = [], []
+    degree = np.zeros(n)
+    rhs = np.zeros(n)
+    col = gap_idx % width
+
+    # Each in-image neighbour adds to the diagonal, gap neighbours become unknowns, known ones go to the right side
+    for step, inside in [(-width, gap_idx >= width), (width, gap_idx < (height - 1) * width),
+                         (-1, col > 0), (1, col < width - 1)]:
+        me = np.flatnonzero(inside)
+        nb = gap_idx[me] + step
+        degree[me] += 1
+
+        unknown = flat_mask[nb]
+        rows.append(me[unknown]) ; cols.append(np.searchsorted(gap_idx, nb[unknown]))
+        rhs[me[~unknown]] += flat_im[nb[~unknown]]
+
+    # Tiny pull towards the current value keeps gaps with no known neighbour (fully empty areas) solvable
+    eps = 1e-6
+    x0 = flat_im[gap_idx].astype(float)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    A = sparse.csr_matrix((-np.ones(len(rows)), (rows, cols)), shape = (n, n)) + sparse.diags(degree + eps)
+    rhs += eps * x0
+
+    if solver == 'direct':
+        x = spsolve(A.tocsc(), rhs)
+    elif solver == 'amg':
+        try:
+            import pyamg
+        except ImportError:
+            raise ImportError("solver 'amg' needs pyamg (pip install pyamg)")
+        x = pyamg.smoothed_aggregation_solver(A).solve(rhs, x0 = x0, tol = 1e-8)
+    else:
+        x, status = cg(A, rhs, x0 = x0)
+
+        # Not converged (status > 0) or breakdown (status < 0): a half-solved fill would be written, solve directly instead
+        if status != 0:
+            print(f'Conjugate gradient did not converge (status {status}), solving directly')
+            x = spsolve(A.tocsc(), rhs)
+
+    # Back to the image type
+    if np.issubdtype(im.dtype, np.integer):
+        limits = np.iinfo(im.dtype)
+        x = np.clip(np.rint(x), limits.min, limits.max)
+    flat_im[gap_idx] = x
+
+    return(im)
+
+
+def reflect101(idx, size):
+    ''' Maps indices outside 0:size back inside like OpenCV's default border (gfedcb|abcdefgh|gfedcba)'''
+
+    idx = np.abs(idx)
+    return(np.where(idx >= size, 2 * (size - 1) - idx, idx))
+
+
+def gap_stencil(im, mask, box_size, gap_idx):
+    ''' Precomputes the gaussian blur restricted to the gap pixels <gap_idx> (flat indices, any order):
+    a sparse matrix G between gap pixels and a constant vector b from the known pixels, so that one 
+    blur round of the gap values u is G @ u + b. Uses the same kernel and border as cv2.GaussianBlur.'''
+
+    from scipy import sparse
+
+    height, width = mask.shape
+    flat_im, flat_mask = im.ravel(), mask.ravel()
+    n, half = len(gap_idx), box_size // 2
+    kernel = cv2.getGaussianKernel(box_size, 0).ravel()
+
+    # Position of each gap pixel in gap_idx, found by binary search in sorted order
+    order = np.argsort(gap_idx)
+    sorted_idx = gap_idx[order]
+    ys, xs = np.divmod(gap_idx, width)
+
+    rows, cols, weights = [], [], []
+    b = np.zeros(n)
+    for dy in range(-half, half + 1):
+        ny = reflect101(ys + dy, height) * width
+        for dx in range(-half, half + 1):
+            nb = ny + reflect101(xs + dx, width)
+            weight = kernel[dy + half] * kernel[dx + half]
+
+            unknown = flat_mask[nb]
+            me = np.flatnonzero(unknown)
+            rows.append(me) ; cols.append(order[np.searchsorted(sorted_idx, nb[me])])
+            weights.append(np.full(len(me), weight))
+            b[~unknown] += weight * flat_im[nb[~unknown]]
+
+    # Duplicate entries (kernel taps reflected onto the same pixel) are summed
+    G = sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))), shape = (n, n))
+
+    return(G, b)
+
+
+def stencil_fill(im, mask, box_size, nloops, tol = None, progress = True, regions = None):
+    ''' Runs nloops gaussian blur rounds on the gap pixels of <im> (in place) as sparse matrix-vector products, 
+    so a round costs time proportional to the number of gap pixels. Values stay floating point between 
+    rounds and are rounded into the image at the end. With <tol>, connected gap regions stop updating 
+    once their largest change is below tol. Returns the number of rounds used and whether all regions 
+    settled before the nloops limit (always False without tol).
+    regions is the output of gap_regions(mask) if already known.'''
+
+    gap_idx, region_starts = gap_regions(mask) if regions is None else regions
+    G, b = gap_stencil(im, mask, box_size, gap_idx)
+    u = im.ravel()[gap_idx].astype(float)
+
+    active = np.ones(len(region_starts), dtype = bool)
+    rounds = 0
+
+    for i in progress_range(nloops, '[green]Applying Gaussian Blur to gridlines ...', progress):
+        if not active.any(): break
+
+        new = G @ u
+        new += b
+        rounds += 1
+
+        if tol is None: 
+            u = new ; continue
+
+        # Only regions still changing take their new values
+        changing = np.maximum.reduceat(np.abs(new - u), region_starts) >= tol
+        active &= changing
+        keep = np.repeat(active, np.diff(np.r_[region_starts, len(u)]))
+        u[keep] = new[keep]
+
+    if np.issubdtype(im.dtype, np.integer):
+        limits = np.iinfo(im.dtype)
+        u = np.clip(np.rint(u), limits.min, limits.max)
+    im.ravel()[gap_idx] = u
+
+    return(rounds, tol is not None and not active.any())
+
+
+def pyramid_fill(im, mask, box_size, nloops, levels = None, engine = 'band'):
+    ''' Coarse-to-fine fill of the gap pixels of <im> (in place). Image and mask are halved <levels> times 
+    (known pixels averaged, a coarse pixel is a gap only if all its pixels are), the coarsest level is 
+    filled with nloops blur rounds, and each finer level starts from the upsampled fill and is refined 
+    with a few rounds of the same small kernel. Wide gaps close at low resolution for a fraction of the cost.
+    levels = None picks enough levels for the widest gap to be about one kernel wide at the top.'''
+
+    # Levels needed to shrink the widest gap (twice its largest distance to a known pixel) to the kernel size
+    if levels is None:
+        widest = 2 * cv2.distanceTransform(mask.view(np.uint8), cv2.DIST_L2, 3).max()
+        levels = int(max(0, np.ceil(np.log2(max(widest, 1) / box_size))))
+    levels = int(min(levels, np.log2(min(mask.shape) / box_size)))
+
+    known = (~mask).astype(np.float32)
+    sums, weights, masks = [im.astype(np.float32) * known], [known], [mask]
+    for l in range(levels):
+        h, w = sums[-1].shape
+        sums.append(cv2.resize(sums[-1], ((w + 1) // 2, (h + 1) // 2), interpolation = cv2.INTER_AREA))
+        weights.append(cv2.resize(weights[-1], ((w + 1) // 2, (h + 1) // 2), interpolation = cv2.INTER_AREA))
+        masks.append(weights[-1] == 0)
+
+    # Fill from the top, each level starting from the upsampled level above
+    filled = None
+    for l in range(levels, -1, -1):
+        level = np.divide(sums[l], weights[l], out = np.zeros_like(sums[l]), where = weights[l] > 0)
+        if filled is None:
+            start, rounds = level[~masks[l]].min(), nloops
+        else:
+            start, rounds = cv2.resize(filled, level.shape[::-1], interpolation = cv2.INTER_LINEAR)[masks[l]], max(2, nloops // 4)
+
+        filled = fill_grids(level, box_size, rounds, engine = engine, fill_value = start, grid_coords = masks[l], progress = False)
+
+    if np.issubdtype(im.dtype, np.integer):
+        limits = np.iinfo(im.dtype)
+        filled = np.clip(np.rint(filled), limits.min, limits.max)
+    im[mask] = filled[mask]
+
+    return(im)
+
+
+def fill_grids(img_array, box_size = 5, nloops = 1, edges = 0, Xtilesize = None, Ytilesize = None, lines = None, engine = 'full', tol = None, info = None,
+               method = 'blur', solver = 'cg', levels = None, fill_value = None, grid_coords = None, out = None, progress = True,
+               cache = None, cache_mb = 2048):
     ''' Fills grid locations (pixel val 0) with values from neighbourhood through a gaussian kernel 
-    Small box sizes yield limited results but work the best with a high loop number (like 20)'''
+    Small box sizes yield limited results but work the best with a high loop number (like 20)
+    engine 'full' blurs the whole image every round, 'band' only blurs strips around the gaps (same result, faster),
+    'stencil' only updates gap pixels through a precomputed sparse blur matrix (see stencil_fill)
 
-    # Grid coordinates and a copy of image
-    grid_coords = img_array == 0
-    im_copy = img_array.copy()   
-    edges = int(edges)
-   
-    # Make grid pixels have the minimum value of image (excluding 0 of grid)
-    im_copy[grid_coords] = min(img_array[img_array > 0].flatten()) 
-
-    if Xtilesize: 
-       # First iteration going through vertical lines 
-       for yjump in range(Ytilesize, panoYmax, Ytilesize):
-           ymin,ymax = yjump -1 ,yjump + 2
-           grid_coords [ymin:ymax,:] = True 
-
-       for xjump in range(Xtilesize, panoXmax, Xtilesize):
-           xmin,xmax = xjump -1 ,xjump + 2
-           grid_coords [:,xmin:xmax] = True 
-    print("Test 2")
+    With a tolerance <tol>, nloops is only an upper bound: a connected gap region stops being blurred once 
+    none of its pixels change by more than tol in a round, and rounds stop when all regions have settled.
+    The number of blur rounds used is stored in the <info> dict if given.
+
+    method 'harmonic' replaces the blur rounds by a single sparse solve (see harmonic_fill), 'pyramid' fills
+    coarse-to-fine over <levels> halvings (see pyramid_fill). Edges are still smoothed after both.
+    fill_value is the starting value of gap pixels, a scalar or one value per gap pixel (default: minimum non-zero value of img_array).
+    A precomputed gap mask can be given as grid_coords (e.g. shared by layers with the same gridlines, restricted 
+    to <lines> when given, see line_mask) and the result written into a preallocated <out> array. 
+    progress = False hides the progress bar and the settled/round limit message.
+
+    With a gridline index <lines> (see detect_gridlines) only zero pixels on those lines are filled and 
+    the image is not scanned for gaps. Xtilesize/Ytilesize add the tile borders as gaps (EXPERIMENTAL).
+    cache is a folder where strips, dilated edges and regions are kept for images with the same gaps (see GapCache).'''
+
+    # Grid coordinates (from the gridline index when there is one) and a copy of image
+    with stage('mask'):
+        if grid_coords is None and lines is not None: grid_coords = line_mask(img_array, lines)
+        elif grid_coords is None: grid_coords = img_array == 0
+        if out is None: 
+            im_copy = img_array.copy()   
+        else:
+            im_copy = out ; im_copy[...] = img_array
+        edges = int(edges)
    
+        # Make grid pixels have the minimum value of image (excluding 0 of grid, found in blocks of rows without a full-size copy)
+        if fill_value is None: fill_value = min_nonzero(img_array)
+        if np.ndim(fill_value) == 0: 
+            np.copyto(im_copy, fill_value, where = grid_coords, casting = 'unsafe')
+        else:
+            im_copy[grid_coords] = fill_value
+
+        # Tile borders are filled too, even without gaps (copy as the mask may be shared)
+        tile_lines = tile_gridlines(img_array.shape, Xtilesize, Ytilesize) if Xtilesize else []
+        if tile_lines:
+            grid_coords = grid_coords.copy()
+            for line in tile_lines: grid_coords[line_slices(line)] = True 
+
+    # Everything derived from the gap mask can come from the cache
+    cache = GapCache(cache, grid_coords, cache_mb) if cache else None
+    cached = cache.get if cache else (lambda name, compute: compute())
 
+    # Rectangles covering the gaps (straight from the gridline index when there is one)
+    grid_rects = lambda halo: cached(f'rects{halo}', lambda: gap_rects(grid_coords, halo) if lines is None else line_rects(lines + tile_lines))
+   
     if edges > 0:
-         # Kernel: here you should define how much the True "dilates"
+        with stage('edges'):
+            # Expand/dilate grid by an edges x edges square, only inside strips around the gaps
+            rects = grid_rects(edges)
+            packed = cached(f'edges{edges}', lambda: np.packbits(dilate_strips(grid_coords, rect_strips(rects, grid_coords.shape, edges), edges)))
+            expanded_grid = np.unpackbits(packed, count = grid_coords.size).view(bool).reshape(grid_coords.shape)
+
+            # Median smoothing strips: the dilated strips plus half a kernel
+            edge_strips = rect_strips(pad_rects(rects, grid_coords.shape, edges), grid_coords.shape, box_size // 2)
+
+    limit, rounds, all_settled = tol, 0, None
+    edge_rounds = min(nloops, 4) if edges else 0
+
+    # Direct solve or sparse blur rounds, only the edge smoothing rounds are left
+    if method == 'harmonic':
+        with stage('harmonic'): harmonic_fill(im_copy, grid_coords, solver)
+        nloops, tol = edge_rounds, None
+
+    elif method == 'pyramid':
+        with stage('pyramid'): pyramid_fill(im_copy, grid_coords, box_size, nloops - edge_rounds, levels, 'full' if engine == 'full' else 'band')
+        nloops, tol = edge_rounds, None
+
+    elif engine == 'stencil':
+        with stage('stencil'): rounds, all_settled = stencil_fill(im_copy, grid_coords, box_size, nloops - edge_rounds, tol, progress, cached('regions', lambda: gap_regions(grid_coords)))
+        nloops, tol = edge_rounds, None
 
-         expansion = np.array([[True] *edges] *edges)
+    # Only blur strips around the gaps (halo of half a kernel keeps the result identical to full frame)
+    with stage('setup'):
+        if engine == 'band' and nloops > edge_rounds: 
+            grid_strips = rect_strips(grid_rects(box_size // 2), grid_coords.shape, box_size // 2)
 
-         # Expand/dilate grid   (https://python.tutorialink.com/how-to-expand-dilate-a-numpy-array/)
-         # Convolution is not possible for bool values, so we convert to int and back. That works because bool(N) == True if N != 0.
-         expanded_grid = convolve2d(grid_coords.astype(int), 
-                                    expansion.astype(int), mode='same').astype(bool)
+        # Adaptive rounds: only pixels of regions that are still changing get filled
+        fill_coords = grid_coords
+        if tol is not None:
+            if engine == 'band': fill_coords = grid_coords.copy()
+            gap_idx, region_starts = cached('regions', lambda: gap_regions(grid_coords))
+            region_stops = np.r_[region_starts[1:], len(gap_idx)].astype(int)
+            settled = np.zeros(len(region_starts), dtype = bool)
+            current = np.empty(len(gap_idx), dtype = im_copy.dtype)
+            before, change = np.empty(len(gap_idx), dtype = np.float32), np.empty(len(gap_idx), dtype = np.float32)
+        if cache: cache.save()
+
+        # Full frame rounds: one blur buffer and flat gap indices, reused by every round (take/put instead of boolean masks)
+        if engine == 'full' and nloops > edge_rounds:
+            blur_img = np.empty(im_copy.shape, dtype = im_copy.dtype)
+            fill_idx = gap_idx if tol is not None else np.flatnonzero(fill_coords)
+            gap_values = np.empty(len(fill_idx), dtype = im_copy.dtype)
    
     # Create a blurred image and replace original grid positions by new blur value. Iterate
-    for i in track(range(nloops),description='[green]Applying Gaussian Blur to gridlines ...'):
+    for i in progress_range(nloops, '[green]Applying Gaussian Blur to gridlines ...', progress):
+        with stage('edge round' if edges and (i > nloops -5) else 'blur round', round = i):
+
+            # Smooth edges as well (last loops only) if asked
+            if edges and (i > nloops -5):
+                band_round(im_copy, expanded_grid, edge_strips, lambda a: cv2.medianBlur(a, box_size))
+                continue
+
+            if tol is not None:
+                if settled.all(): continue 
+                np.copyto(before, np.take(im_copy, gap_idx, out = current))
 
-        # Smooth edges as well (last loops only) if asked
-        if edges and (i > nloops -5):
-            blur_img =  cv2.medianBlur(im_copy,box_size,cv2.BORDER_DEFAULT) 
-            im_copy[expanded_grid] = blur_img[expanded_grid]     
+            if engine == 'band':
+                band_round(im_copy, fill_coords, grid_strips, lambda a: cv2.GaussianBlur(a, (box_size,box_size), 0))
             
-        else: # Main condition
-            blur_img = cv2.GaussianBlur(im_copy,(box_size,box_size), 0)   # Gaussian kernel
-            im_copy[grid_coords] = blur_img[grid_coords]
+            else: # Main condition
+                cv2.GaussianBlur(im_copy,(box_size,box_size), 0, dst = blur_img)   # Gaussian kernel
+                values = gap_values[:len(fill_idx)]
+                np.put(im_copy, fill_idx, np.take(blur_img, fill_idx, out = values))
+            rounds += 1
+
+            # Regions whose largest change is below tolerance drop out of the next rounds
+            if tol is not None and len(gap_idx):
+                np.subtract(np.take(im_copy, gap_idx, out = current), before, out = change)
+                newly = (np.maximum.reduceat(np.abs(change, out = change), region_starts) < tol) & ~settled
+                if newly.any():
+                    settled |= newly
+                    if engine == 'band':
+                        for r in np.flatnonzero(newly): fill_coords.ravel()[gap_idx[region_starts[r]:region_stops[r]]] = False
+                    else:
+                        fill_idx = np.concatenate([gap_idx[region_starts[r]:region_stops[r]] for r in np.flatnonzero(~settled)] + [gap_idx[:0]])
+
+    # Settled regions stop the rounds early, otherwise nloops was the limit
+    if tol is not None: all_settled = settled.all()
+    if progress and limit is not None and all_settled is not None:
+        print(f'Gaps settled after {rounds} rounds' if all_settled else f'Round limit reached after {rounds} rounds, some gaps still change by {limit} or more')
+    if info is not None: info['rounds'] = rounds
 
     return(im_copy)
 
 
+def report_gridlines(img):
+    ''' Detects the gridlines of a panorama (first layer of 3D ones) and prints what was found'''
+
+    lines, (xpitch, ypitch) = detect_gridlines(img, 0 if len(img.shape) > 2 else None)
+    print(f'Detected {len(lines)} gridline segments, tile pitch X: {xpitch}, Y: {ypitch}')
+
+    return(lines)
+
+
+def fill_file(path_file, out_file = None, workers = 1, chunksize = None, detect = False, ome = None, **params):
+    ''' Fills the gridlines of one panorama file (2D, or 3D/multichannel layer by layer) and writes 
+    <out_file> (default see output_name). workers layers are filled in parallel, chunksize fills 
+    out-of-core tile by tile (see fill_tiled), detect restricts the fill to detected gridlines, 
+    ome (dict of write_ome options) writes a tiled pyramidal OME-TIFF. 
+    Other parameters go to fill_grids. Returns the output path.'''
+
+    pathname, extension = os.path.splitext(path_file)
+    out_file = out_file or output_name(path_file, ome)
+
+    # Out-of-core: stream tiles from the input into a memory-mapped output tif
+    if chunksize:
+        import tifffile
+        if 'tif' not in extension or 'tif' not in os.path.splitext(out_file)[1]:
+            raise ValueError("chunksize needs tif input and output")
+        if params.get('Xtilesize'):
+            raise ValueError("Xtilesize is not supported with chunksize")
+        if params.get('method', 'blur') != 'blur':
+            raise ValueError("chunksize only supports the blur method")
+
+        src = open_img(path_file)
+        if detect: params['lines'] = report_gridlines(src)
+
+        # OME output is converted from a temporary memory-mapped tif, tile by tile
+        filled_file = out_file if ome is None else out_file + '.tmp.tif'
+        out = tifffile.memmap(filled_file, shape = src.shape, dtype = src.dtype)
+
+        with stage('fill', file = path_file), ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda l: fill_tiled(src, out, tile = chunksize, layer = l, **params), 
+                          range(src.shape[0]) if len(src.shape) > 2 else [None]))
+        out.flush()
+
+        if ome is not None:
+            write_ome(out_file, out, **ome)
+            del out ; os.remove(filled_file)
+
+        return(out_file)
+
+    # Read input as tif file or as png/jpg
+    img = load_img(path_file) 
+
+    # Save as tif file or as png/
+    with stage('fill', file = path_file): filled = fill_array(img, workers, detect, **params)
+    write_img(out_file, filled, ome)
+
+    return(out_file)
+
+
+def fill_array(img, workers = 1, detect = False, **params):
+    ''' Fills the gridlines of an in-memory 2D image or 3D/multichannel stack (layers in parallel with 
+    <workers> threads, sharing one gap mask when they have the same gridlines). Parameters as fill_file.'''
+
+    # Gridline index shared by all layers
+    if detect: params['lines'] = report_gridlines(img)
+
+    # Apply fill_grids function and write to file #####
+        # Work on composite images or z-layered tiffs
+    if len(img.shape) > 2: 
+        from rich.progress import track
+
+        # Layers with the same gridlines share one gap mask (only zeros on the lines of a gridline index)
+        lines = params.get('lines')
+        gaps = (lambda layer: layer == 0) if lines is None else (lambda layer: line_mask(layer, lines))
+        shared_grid = gaps(img[0])
+        if not all(np.array_equal(gaps(img[l]), shared_grid) for l in range(1, img.shape[0])): shared_grid = None
+
+        # Fill layers in parallel (OpenCV releases the GIL) straight into the output stack
+        filled = np.empty_like(img)
+        fill_layer = lambda l: fill_grids(img_array=img[l,:,:], grid_coords = shared_grid, out = filled[l], progress = False, **params)
+
+        # With a cache, the first layer fills the entry of the shared mask before the other layers read it
+        layers = range(img.shape[0])
+        if params.get('cache') and shared_grid is not None: 
+            fill_layer(0) ; layers = layers[1:]
+
+        with ThreadPoolExecutor(workers) as pool:
+            list(track(pool.map(fill_layer, layers), total = len(layers), description='[green]Filling gridlines of each layer ...'))
+        img = filled
+
+    else: # Work on 2D images
+
+        img = fill_grids(img_array=img, **params)
+
+    return(img)
+
+
+def find_inputs(inputs, extensions = ('.tif', '.tiff', '.png', '.jpg')):
+    ''' Expands a list of files, directories and glob patterns into the panorama files to fill 
+    (outputs of earlier runs, *_gridfilled.*, are left out of directories and patterns).
+    Raises FileNotFoundError naming the inputs that match no file.'''
+
+    files, missing = [], []
+    for i in inputs:
+        if os.path.isfile(i): 
+            files.append(i) ; continue
+
+        found = sorted(glob.glob(os.path.join(i, '*')) if os.path.isdir(i) else glob.glob(i))
+        found = [f for f in found if os.path.splitext(f)[1].lower() in extensions and '_gridfilled' not in f]
+        if not found: missing.append(i)
+        files += found
+
+    if missing: raise FileNotFoundError(f"Input file does not exist: {', '.join(missing)}")
+
+    return(files)
+
+
+def fill_pipeline(files, prefetch = 2, ome = None, **params):
+    ''' Fills files with reading, filling and writing overlapped: a reader thread decodes the next files 
+    and a writer thread encodes the previous results while the current one is filled (layers in parallel 
+    with workers). At most <prefetch> images wait on each side, which caps memory. Returns the output paths.
+    Files that cannot be read or written are skipped and the first of their errors is raised at the end.'''
+
+    import queue, threading
+
+    to_fill, to_write = queue.Queue(maxsize = prefetch), queue.Queue(maxsize = prefetch)
+    outputs, errors = [], []
+    stop = threading.Event()
+
+    def reader():
+        for path_file in files:
+            if stop.is_set(): break
+            try:
+                to_fill.put((path_file, load_img(path_file)))
+            except Exception as e: 
+                errors.append(e)
+        to_fill.put(None)
+
+    def writer():
+        while True:
+            item = to_write.get()
+            if item is None: return
+            try:
+                write_img(*item, ome) ; outputs.append(item[0])
+            except Exception as e: 
+                errors.append(e)
+
+    threads = [threading.Thread(target = reader, daemon = True), threading.Thread(target = writer, daemon = True)]
+    for t in threads: t.start()
+
+    try:
+        for n, (path_file, img) in enumerate(iter(to_fill.get, None)):
+            print(f'[{n + 1}/{len(files)}] {path_file}')
+            with stage('fill', file = path_file): filled = fill_array(img, **params)
+            to_write.put((output_name(path_file, ome), filled))
+
+    # Also when a fill fails: stop the reader (unblocking its put) and let the writer finish the files it holds
+    finally:
+        stop.set()
+        while threads[0].is_alive():
+            try: to_fill.get(timeout = 0.1)
+            except queue.Empty: pass
+
+        to_write.put(None)
+        for t in threads: t.join()
+
+    if errors: raise errors[0]
+
+    return(outputs)
+
+
+def fill_batch(inputs, prefetch = 0, **params):
+    ''' Fills every panorama given as files, directories or glob patterns in one process 
+    (modules and OpenCV are loaded once). Parameters go to fill_file. Returns the output paths.
+    prefetch > 0 overlaps reading, filling and writing with that many images queued (see fill_pipeline).'''
+
+    files = find_inputs(inputs)
+    if prefetch and not params.get('chunksize'):
+        params.pop('chunksize', None)
+        return(fill_pipeline(files, prefetch, **params))
+
+    outputs = []
+
+    for n, path_file in enumerate(files):
+        print(f'[{n + 1}/{len(files)}] {path_file}')
+        outputs.append(fill_file(path_file, **params))
+
+    return(outputs)
+
+
 #################################################################################
 
                         
 if __name__ == '__main__':
-    import os,glob, argparse
-    from scipy.signal import convolve2d
-    import numpy as np
-    import matplotlib.pyplot as plt
-    from rich.progress import track
+    import argparse
 
-    #increase max allowed image size
-    os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"] = pow(2,40).__str__()
-    
-    version_number = "0.0.4"
-
-    import tifffile,  cv2  
-
-    parser = argparse.ArgumentParser(description="Takes a single panorama image and fills the empty grid lines with neighbour-weighted values" )
-    parser.add_argument("input", help="Input tif/png file with grid lines to fill")
+    parser = argparse.ArgumentParser(description="Takes panorama images and fills the empty grid lines with neighbour-weighted values" )
+    parser.add_argument("input", nargs = '+', help="Input tif/png files with grid lines to fill (also directories or glob patterns, all processed in one run)")
     parser.add_argument("-s", "--sizekernel", nargs = '?', type=int, default = 5,  help="Box size for gaussian kernel (bigger better for big gaps but less accurate)")
     parser.add_argument("-r", "--rounds",    nargs = '?', type=int, default = 40, help="Number of rounds to apply gaussianBlur (more is better)")
     parser.add_argument("-xt", "--Xtilesize", nargs = '?', type=int, default = None,  help="Tile size (distance between gridlines) on X axis")
     parser.add_argument("-yt", "--Ytilesize", nargs = '?', type=int, default = None,  help="Tile size (distance between gridlines) on Y axis")
 
+    parser.add_argument("-d", '--detect', action='store_true', default = False, help="Detect gridlines (position, width, pitch) and only fill zero pixels on them")
     parser.add_argument("-e", '--edges', nargs = '?', default = 0, help="Also smooth edges near grid lines")
+    parser.add_argument("-t", "--tolerance", nargs = '?', type=float, default = None, help="Stop filling a gap region once its pixels change less than this per round (--rounds becomes a maximum). Use >= 1 on integer images")
+    parser.add_argument("-m", '--method', choices = ['blur', 'harmonic', 'pyramid'], default = 'blur', help="'blur' iterates gaussian blur rounds, 'harmonic' solves the smooth fill directly in one step, 'pyramid' fills coarse-to-fine (wide gaps with a small kernel)")
+    parser.add_argument("-l", '--levels', nargs = '?', type=int, default = None, help="Number of halvings for --method pyramid (default: enough for the widest gap)")
+    parser.add_argument('--solver', choices = ['cg', 'direct', 'amg'], default = 'cg', help="Sparse solver for --method harmonic ('amg' multigrid needs pyamg, best for wide gaps)")
+    parser.add_argument("-en", '--engine', choices = ['full', 'band', 'stencil'], default = 'full', help="'full' blurs whole image each round, 'band' only strips around gridlines (same result, much faster on big panoramas), 'stencil' only gap pixels through a sparse blur matrix")
+    parser.add_argument("-c", '--chunksize', nargs = '?', type=int, default = None, help="Fill out-of-core in tiles of this size: input is memory mapped (or read through zarr) and output written to a memory-mapped tif (--method blur only)")
+    parser.add_argument('--cache', nargs = '?', default = None, help="Folder to keep gap strips/edge masks in, reused by later files with the same gridlines (same acquisition)")
+    parser.add_argument('--cache-size', nargs = '?', type=int, default = 2048, help="Maximum size of the --cache folder in MB (least recently used files are deleted)")
+    parser.add_argument("-o", '--ome', action='store_true', default = False, help="Write a tiled, compressed, pyramidal OME-TIFF (<name>_gridfilled.ome.tif)")
+    parser.add_argument('--compression', choices = ['zlib', 'zstd', 'none'], default = 'zlib', help="Tile compression of --ome output ('zstd' needs imagecodecs)")
+    parser.add_argument("-p", '--prefetch', nargs = '?', type=int, default = 0, help="Overlap reading, filling and writing of several inputs, with up to this many images queued before and after filling")
+    parser.add_argument("-w", '--workers', nargs = '?', type=int, default = None, help="Number of z-layers/channels filled in parallel (default 1) and of --ome compression threads (default chosen by tifffile)")
+    parser.add_argument('--report', nargs = '?', default = None, help="Record wall/CPU time and memory of every stage (read, mask, edges, rounds, write) into this JSON or .csv file")
+    parser.add_argument('--profile', nargs = '?', default = None, help="Run under cProfile and save the statistics to this file (main thread only)")
     parser.add_argument("-v", '--version', action='store_true', default = False, help="Print version number.")
     args=parser.parse_args()
 
@@ -120,42 +1074,37 @@ if __name__ == '__main__':
     if args.version:        print(version_number) ; exit()
 
     # Sanity checks of input
-    pathname, extension = os.path.splitext(args.input)
-
-    if os.path.exists(args.input) == False:
-        print("Input file does not exist!") ; exit()
+    try:
+        inputs = find_inputs(args.input)
+    except FileNotFoundError as e:
+        print(e) ; exit(1)
 
     # Inputs
     Xtilesize = args.Xtilesize #2144
     Ytilesize = args.Xtilesize if args.Ytilesize == None else args.Ytilesize 
 
+    if args.chunksize and Xtilesize:
+        print("--Xtilesize is not supported with --chunksize") ; exit()
 
-    # Read input as tif file or as png/jpg
-    img = read_img(args.input) 
-    panoYmax,panoXmax  = img.shape [-2:]
-    
-    print("Test 1")
-
-    # Apply fill_grids function and write to file #####
-        # Work on composite images or z-layered tiffs
-    if len(img.shape) > 2: 
-        layers = []
-        for l in range(img.shape[0]):
-
-            layers.append(fill_grids(img_array=img[l,:,:], box_size = args.sizekernel, nloops= args.rounds, edges = args.edges))
-        img = np.array(layers )
-
-    else: # Work on 2D images
+    if args.chunksize and args.method != 'blur':
+        print("--chunksize only supports --method blur") ; exit()
 
-        img = fill_grids(img_array=img, box_size = args.sizekernel, nloops= args.rounds, edges = args.edges)
+    if args.report: record_stages()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile() ; profiler.enable()
 
+    fill_batch(inputs, prefetch = args.prefetch, workers = args.workers or 1, chunksize = args.chunksize, detect = args.detect, 
+               ome = dict(compression = args.compression, workers = args.workers) if args.ome else None,
+               box_size = args.sizekernel, nloops = args.rounds, edges = args.edges, engine = args.engine,
+               Xtilesize = Xtilesize, Ytilesize = Ytilesize,
+               tol = args.tolerance, method = args.method, solver = args.solver, levels = args.levels,
+               cache = args.cache, cache_mb = args.cache_size)
 
+    if args.profile:
+        import pstats
+        profiler.disable() ; profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+        print(f'Saving: {args.profile}')
 
-    # Save as tif file or as png/
-
-    #cv2.imwrite(pathname + '_gridfilled' + extension, img)
-
-    if 'tif' in extension:
-        tifffile.imwrite(pathname + '_gridfilled' + extension, img)
-    else:
-        cv2.imwrite(pathname + '_gridfilled' + extension, img)
+    if args.report: save_stages(args.report)